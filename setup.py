@@ -57,6 +57,9 @@ setup(
             "plone.app.testing",
             "ecreall.helpers.testing",
         ],
+        "inotify": [
+            "pyinotify",
+        ],
     },
     entry_points="""
       # -*- Entry points: -*-
@@ -64,5 +67,7 @@ setup(
       target = plone
       [console_scripts]
       batchimport_add_metadata = collective.dms.batchimport.script:add_metadata
+      [zopectl.command]
+      batchimport = collective.dms.batchimport.script:batchimport
       """,
 )
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""Zip and tar archives imported as virtual directories.
+
+The members of an archive are imported as if they were files of the
+directory holding the archive, e.g. ``in-mail.pdf`` and ``sub/in-mail.pdf``
+of ``incoming-mails/drop.zip`` go to ``incoming-mails`` and
+``incoming-mails/sub``. They are read straight from the archive, which is
+only processed once all its members are imported. Meanwhile, committed
+members are recorded in a hidden progress file next to the archive.
+
+A compressed tar archive is decompressed from its start again whenever a
+member before the last read one is read, and metadata members usually
+follow their file. They are thus all read at once, in archive order, when
+the archive is opened, so that the files are then read forward only.
+"""
+import collections
+import json
+import os
+import tarfile
+import threading
+import zipfile
+
+
+ARCHIVE_EXTENSIONS = (".zip", ".tar", ".tar.gz", ".tgz")
+
+
+def is_archive(filename):
+    return filename.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def get_progress_filepath(filepath):
+    return os.path.join(os.path.dirname(filepath), ".%s.progress" % os.path.basename(filepath))
+
+
+def split_path(filepath):
+    """Split the path of an archive member in the archive path and the member name.
+
+    Return (filepath, None) for a path that is not in an archive.
+    """
+    path = os.path.dirname(filepath)
+    while True:
+        parent = os.path.dirname(path)
+        if parent == path:
+            return (filepath, None)
+        if is_archive(os.path.basename(path)) and os.path.isfile(path):
+            return (path, filepath[len(path) + 1 :])
+        path = parent
+
+
+class ArchiveError(Exception):
+    pass
+
+
+class Archive(object):
+    """Members of an archive, read by one thread at a time."""
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.lock = threading.Lock()
+        # member name -> member of the zip or tar file
+        self.members = collections.OrderedDict()
+        # member name -> content of the metadata members of a tar file
+        self.metadata = {}
+        try:
+            if zipfile.is_zipfile(filepath):
+                self.archive = zipfile.ZipFile(filepath)
+                infos = [info for info in self.archive.infolist() if not info.filename.endswith("/")]
+                self.add_members((info.filename, info) for info in infos)
+            else:
+                self.archive = tarfile.open(filepath)
+                self.add_members((info.name, info) for info in self.archive.getmembers() if info.isfile())
+                for name in self.members:
+                    if name.endswith(".metadata"):
+                        self.metadata[name] = self.read_member(name)
+        except (IOError, zipfile.BadZipfile, tarfile.TarError) as e:
+            raise ArchiveError("cannot read archive %s (%s)" % (filepath, e))
+        self.progress_filepath = get_progress_filepath(filepath)
+        self.done = set()
+        if os.path.exists(self.progress_filepath):
+            self.done.update(json.loads(line) for line in open(self.progress_filepath) if line.endswith("\n"))
+
+    def add_members(self, members):
+        for name, info in members:
+            if not isinstance(name, unicode):
+                name = name.decode("utf8", "replace")
+            if not any(part.startswith(".") for part in name.split("/")):
+                self.members[name] = info
+
+    def get_path(self, name):
+        """Virtual path of a member."""
+        return os.path.join(self.filepath, *name.split("/"))
+
+    def get_name(self, path):
+        """Member name of a virtual path."""
+        name = path[len(self.filepath) + 1 :].replace(os.sep, "/")
+        if not isinstance(name, unicode):
+            name = name.decode("utf8")
+        return name
+
+    def get_entries(self):
+        """Return (member, metadata member or None) of the members to import, in archive order."""
+        entries = []
+        for name in self.members:
+            if not name.endswith(".metadata"):
+                metadata_name = name + ".metadata"
+                entries.append((name, metadata_name if metadata_name in self.members else None))
+        return entries
+
+    def get_remaining_entries(self):
+        return [(name, metadata_name) for name, metadata_name in self.get_entries() if name not in self.done]
+
+    def open(self, name):
+        """Return a file object reading a member, to use while holding the lock."""
+        info = self.members[name]
+        if isinstance(self.archive, zipfile.ZipFile):
+            return self.archive.open(info)
+        return self.archive.extractfile(info)
+
+    def read(self, name):
+        if name in self.metadata:
+            return self.metadata[name]
+        with self.lock:
+            return self.read_member(name)
+
+    def read_member(self, name):
+        stream = self.open(name)
+        try:
+            return stream.read()
+        finally:
+            stream.close()
+
+    def mark_as_done(self, name):
+        """Record that a member is committed."""
+        self.done.add(name)
+        with open(self.progress_filepath, "a") as fd:
+            fd.write(json.dumps(name) + "\n")
+
+    def is_complete(self):
+        for name, metadata_name in self.get_entries():
+            if name not in self.done or (metadata_name is not None and metadata_name not in self.done):
+                return False
+        return True
+
+    def close(self):
+        self.archive.close()
@@ -1,60 +1,265 @@
 # -*- coding: utf-8 -*-
+from Acquisition import aq_base
 from collective.dms.batchimport import _
+from collective.dms.batchimport import archives
+from collective.dms.batchimport import deferred
+from collective.dms.batchimport import hashes
+from collective.dms.batchimport import indexing
+from collective.dms.batchimport import jobs
+from collective.dms.batchimport import manifest
+from collective.dms.batchimport import quarantine
+from collective.dms.batchimport import references
+from collective.dms.batchimport import routing
 from collective.dms.batchimport import utils
+from collective.dms.batchimport.claims import DirectoryClaims
+from collective.dms.batchimport.claims import ImportLock
+from collective.dms.batchimport.claims import SharedImportLock
+from collective.dms.batchimport.events import BatchImportFinishedEvent
+from collective.dms.batchimport.metadata import METADATA_FILENAMES
+from collective.dms.batchimport.metadata import MetadataError
+from collective.dms.batchimport.metadata import read_directory_metadata
+from collective.dms.batchimport.pipeline import Prefetcher
+from collective.dms.batchimport.stats import ImportStats
 from collective.z3cform.datagridfield import DataGridFieldFactory
 from collective.z3cform.datagridfield.registry import DictRow
 from natsort import humansorted
 from plone.app.registry.browser import controlpanel
 from plone.autoform.directives import widget
 from plone.i18n.normalizer.interfaces import IIDNormalizer
-from plone.namedfile.file import NamedBlobFile
 from plone.registry.interfaces import IRegistry
 from Products.CMFCore.utils import getToolByName
 from Products.Five.browser import BrowserView
+from ZODB.POSException import ConflictError
 from zope import component
 from zope import schema
 from zope.component import queryUtility
+from zope.event import notify
 from zope.interface import Interface
 
+import collections
+import glob
+import hashlib
 import json
 import logging
 import os
+import random
+import shutil
+import time
+import transaction
 
 
 log = logging.getLogger("collective.dms.batchimport")
 
+# files waiting for their batch to be committed before being moved
+JOURNAL_FILENAME = ".batchimport-journal"
+
+
+# orders of the imported files
+DIRECTORY_ORDER = "directory"
+OLDEST_ORDER = "oldest"
+ROUND_ROBIN_ORDER = "round_robin"
+
+# seconds waited after a first conflict, doubled at each retry
+CONFLICT_BACKOFF = 0.1
+
 
 class BatchImportError(Exception):
     pass
 
 
+def is_importable(filename):
+    """Tell if a file of a directory is imported, rather than being a metadata or hidden file."""
+    return not filename.endswith(".metadata") and not filename.startswith(".") and filename not in METADATA_FILENAMES
+
+
+class ImportEntry(object):
+    """A file to import, with its optional metadata file.
+
+    Files of an archive have virtual paths below the archive path.
+    """
+
+    def __init__(self, foldername, filepath, metadata_filepath=None, archive=None):
+        self.foldername = foldername
+        self.filepath = filepath
+        self.metadata_filepath = metadata_filepath
+        self.archive = archive
+        # directory of the root directory holding the file or its archive
+        self.directory = foldername
+        self.metadata = None
+        self.signature = None
+        # already handled and not modified since
+        self.unchanged = False
+        # last entry of its directory
+        self.last = False
+        # error reading the entry, recorded against it when its turn comes
+        self.error = None
+
+    @property
+    def filepaths(self):
+        if self.metadata_filepath:
+            return (self.metadata_filepath, self.filepath)
+        return (self.filepath,)
+
+
 class ICodeTypeMapSchema(Interface):
     code = schema.TextLine(title=_("Code"))
     portal_type = schema.TextLine(title=_("Portal Type"))
 
 
+class IRoutingRuleSchema(Interface):
+    match = schema.Choice(title=_("Match"), values=[routing.CODE, routing.PREFIX, routing.REGEX], default=routing.CODE)
+    pattern = schema.TextLine(title=_("Code, prefix or regular expression"))
+    folder = schema.TextLine(title=_("Directory"), required=False)
+    portal_type = schema.TextLine(title=_("Portal Type"))
+    mainfile_type = schema.TextLine(title=_("File portal type"), required=False)
+    owner = schema.TextLine(title=_("Owner"), required=False)
+    metadata = schema.TextLine(title=_("Default metadata (json)"), required=False)
+
+
 class ISettings(Interface):
     fs_root_directory = schema.TextLine(title=_("FS Root Directory"))
 
     processed_fs_root_directory = schema.TextLine(title=_("FS Root Directory for processed files"))
 
+    quarantine_fs_root_directory = schema.TextLine(
+        title=_("FS Root Directory for files that cannot be imported"), required=False
+    )
+
+    upload_spool_directory = schema.TextLine(title=_("Directory receiving chunked uploads"), required=False)
+
     code_to_type_mapping = schema.List(
-        title=_("Code to Portal Type Mapping"), value_type=DictRow(title=_("Mapping"), schema=ICodeTypeMapSchema)
+        title=_("Code to Portal Type Mapping"),
+        value_type=DictRow(title=_("Mapping"), schema=ICodeTypeMapSchema),
+        required=False,
     )
     widget(code_to_type_mapping=DataGridFieldFactory)
 
+    routing_rules = schema.List(
+        title=_("Routing rules, applied before the code mapping"),
+        value_type=DictRow(title=_("Rule"), schema=IRoutingRuleSchema),
+        required=False,
+    )
+    widget(routing_rules=DataGridFieldFactory)
+
+    batch_size = schema.Int(title=_("Number of documents per transaction"), default=100, min=1, required=False)
+
+    conflict_retries = schema.Int(
+        title=_("Number of retries of a document or a batch on conflicts"), default=3, min=0, required=False
+    )
+
+    hardlink_blobs = schema.Bool(title=_("Hard link files into the blob storage"), default=False, required=False)
+
+    claim_directories = schema.Bool(
+        title=_("Share directories between concurrent imports"), default=False, required=False
+    )
+
+    claim_timeout = schema.Int(
+        title=_("Delay (in seconds) after which an abandoned directory is imported again"),
+        default=3600,
+        min=1,
+        required=False,
+    )
+
+    scan_manifest = schema.Bool(
+        title=_("Skip files already handled and not modified since"), default=False, required=False
+    )
+
+    prefetch_workers = schema.Int(
+        title=_("Number of threads reading files in advance"), default=0, min=0, required=False
+    )
+
+    defer_indexing = schema.Bool(title=_("Index documents once per transaction"), default=False, required=False)
+
+    reserve_reference_numbers = schema.Bool(
+        title=_("Reserve internal reference numbers by blocks"), default=False, required=False
+    )
+
+    deferred_subscribers = schema.List(
+        title=_("Dotted names of the event subscribers run later by a separate worker"),
+        value_type=schema.TextLine(),
+        required=False,
+    )
+
+    max_cache_objects = schema.Int(
+        title=_("Number of objects in the ZODB cache committing a batch early"), min=1, required=False
+    )
+
+    max_memory = schema.Int(title=_("Resident memory, in megabytes, committing a batch early"), min=1, required=False)
+
+    max_documents = schema.Int(title=_("Maximum number of documents per import"), min=1, required=False)
+
+    max_bytes = schema.Int(title=_("Maximum number of bytes per import"), min=1, required=False)
+
+    max_seconds = schema.Int(title=_("Maximum duration of an import, in seconds"), min=1, required=False)
+
+    ordering = schema.Choice(
+        title=_("Import order"), values=[DIRECTORY_ORDER, OLDEST_ORDER, ROUND_ROBIN_ORDER], required=False
+    )
+
+    duplicate_content_policy = schema.Choice(
+        title=_("Policy for files whose content was already imported"),
+        values=[hashes.SKIP, hashes.LINK, hashes.IMPORT],
+        required=False,
+    )
+
 
 class BatchImporter(BrowserView):
     def __call__(self):
+        if not self.setup():
+            return "ERROR"
+        if self.request.get("background"):
+            return self.start_job()
+        if not self.lock.acquire():
+            return "ERROR (an import is already running)"
+        try:
+            summary = self.run()
+        finally:
+            self.lock.release()
+        if self.request.get("report") == "json":
+            self.request.response.setHeader("Content-Type", "application/json")
+            return json.dumps(summary)
+        return "OK (%s imported files, %s unprocessed files)" % (self.nb_imports, self.nb_errors)
+
+    def start_job(self):
+        """Run the import in a background job, answer its id in json."""
+        self.request.response.setHeader("Content-Type", "application/json")
+        job = jobs.start(self, queue=bool(self.request.get("queue")))
+        if job is None:
+            self.request.response.setStatus(409)
+            running = [
+                status["job"] for status in jobs.get_statuses(self.fs_root_directory) if status["state"] == jobs.RUNNING
+            ]
+            return json.dumps({"error": "an import is already running", "running": running})
+        return json.dumps({"job": job.id, "state": job.state})
+
+    def setup(
+        self,
+        batch_size=None,
+        dry_run=False,
+        limit=None,
+        paths=(),
+        progress=None,
+        max_documents=None,
+        max_bytes=None,
+        max_seconds=None,
+        ordering=None,
+    ):
+        """Read the settings, return False if the import cannot run.
+
+        dry_run checks the files without creating anything, limit is the maximum
+        number of files to handle, paths are patterns restricting the imported
+        files and progress is called with a summary after each batch.
+        max_documents, max_bytes, max_seconds and ordering override the settings.
+        """
         settings = component.getUtility(IRegistry).forInterface(ISettings, False)
 
         if not settings.fs_root_directory:
             log.warning("settings.fs_root_directory is not defined")
-            return "ERROR"
+            return False
 
         if not os.path.exists(settings.fs_root_directory):
             log.warning("settings.fs_root_directory do not exist")
-            return "ERROR"
+            return False
 
         self.fs_root_directory = settings.fs_root_directory
         if not self.fs_root_directory.endswith("/"):
@@ -64,62 +269,733 @@ class BatchImporter(BrowserView):
         if not self.processed_fs_root_directory.endswith("/"):
             self.processed_fs_root_directory = self.processed_fs_root_directory + "/"
 
-        self.code_to_type_mapping = dict()
-        for mapping in settings.code_to_type_mapping:
-            self.code_to_type_mapping[mapping["code"]] = mapping["portal_type"]
+        self.quarantine_fs_root_directory = settings.quarantine_fs_root_directory
+        if self.quarantine_fs_root_directory and not self.quarantine_fs_root_directory.endswith("/"):
+            self.quarantine_fs_root_directory = self.quarantine_fs_root_directory + "/"
+
+        try:
+            self.router = routing.get_router(settings.routing_rules, settings.code_to_type_mapping)
+        except routing.RoutingError as e:
+            log.warning("settings.routing_rules are invalid (%s)" % e)
+            return False
+
+        self.folders = utils.FolderResolver(self.context)
+        self.index = utils.ImportIndex(self.context, self.router.portal_types)
+        self.owners = utils.OwnerCache(self.context)
+
+        self.batch_size = batch_size or settings.batch_size or 100
+        self.conflict_retries = settings.conflict_retries if settings.conflict_retries is not None else 3
+        self.dry_run = dry_run
+        self.limit = limit
+        self.paths = [path.strip("/") for path in paths]
+        self.progress = progress
+        self.hardlink_blobs = bool(settings.hardlink_blobs)
+        self.prefetch_workers = settings.prefetch_workers or 0
+        # budgets, the import stops before the next file once one is spent
+        self.max_documents = max_documents or settings.max_documents
+        self.max_bytes = max_bytes or settings.max_bytes
+        self.max_seconds = max_seconds or settings.max_seconds
+        self.ordering = ordering or settings.ordering or DIRECTORY_ORDER
+        # name of the spent budget
+        self.stopped = None
+        # directory of the file being imported, reported by background jobs
+        self.current_directory = None
+        # high-water marks, the current batch is committed early and the object cache emptied once one is reached
+        self.max_cache_objects = settings.max_cache_objects
+        self.max_memory = settings.max_memory
+        # marks that emptying the cache did not bring usage below, ignored until it drops below them
+        self.latched_high_water = set()
+        self.journal_filepath = os.path.join(self.fs_root_directory, JOURNAL_FILENAME)
+        # (document path, filepaths, signature) imported in the current, uncommitted, batch
+        self.pending = []
+        # entries of the current batch, imported again on conflicts
+        self.batch_entries = []
+        # documents created in the current batch, turned back into ghosts once committed
+        self.created = []
+        # (filepaths, signature, error) that could not be imported in the current batch
+        self.failed = []
+        self.nb_imports = 0
+        self.nb_errors = 0
+        self.stats = ImportStats()
+
+        # a single import of the root directory at a time, whichever process runs it, unless they claim directories
+        if settings.claim_directories:
+            self.lock = SharedImportLock(self.fs_root_directory, settings.claim_timeout or 3600)
+        else:
+            self.lock = ImportLock(self.fs_root_directory, settings.claim_timeout or 3600)
+
+        # concurrent imports, e.g. on several ZEO clients, each claim their own directories
+        self.claims = None
+        if settings.claim_directories:
+            self.claims = DirectoryClaims(self.fs_root_directory, settings.claim_timeout or 3600)
+            self.journal_filepath = "%s-%s" % (self.journal_filepath, self.claims.worker_id)
+        # directories whose files are all imported, released on next commit
+        self.finished_directories = []
+
+        self.manifest = None
+        if settings.scan_manifest and not dry_run:
+            self.manifest = manifest.ScanManifest(os.path.join(self.fs_root_directory, manifest.MANIFEST_FILENAME))
+
+        # opened archives, by path
+        self.archives = {}
+
+        self.duplicate_content_policy = settings.duplicate_content_policy
+        self.hashes = None
+        if self.duplicate_content_policy and not dry_run:
+            self.hashes = hashes.HashIndex(getToolByName(self.context, "portal_url").getPortalObject())
+
+        self.indexing_queue = None
+        if settings.defer_indexing and not dry_run:
+            self.indexing_queue = indexing.IndexingQueue(self.context)
+
+        self.references = None
+        if settings.reserve_reference_numbers and not dry_run:
+            self.references = references.ReferenceAllocator(self.context, self.request, block_size=self.batch_size)
+
+        self.dispatch = None
+        suppressed = references.COUNTER_SUBSCRIBERS if self.references is not None else ()
+        if (settings.deferred_subscribers or suppressed) and not dry_run:
+            self.dispatch = deferred.DeferredDispatch(
+                getToolByName(self.context, "portal_url").getPortalObject(),
+                deferred=settings.deferred_subscribers or (),
+                suppressed=suppressed,
+            )
+        return True
+
+    def run(self, filepaths=None):
+        """Import the files of the root directory, return a summary.
+
+        filepaths, relative to the root directory, restricts the import to
+        these files without walking the whole tree.
+        """
+        if not self.dry_run:
+            self.recover_journal()
+
+        if self.indexing_queue is not None:
+            indexing.activate(self.indexing_queue)
+        if self.dispatch is not None:
+            deferred.activate(self.dispatch)
+        try:
+            self.import_tree(filepaths)
+            if self.dry_run:
+                transaction.abort()
+            else:
+                self.commit()
+        finally:
+            if self.indexing_queue is not None:
+                indexing.deactivate()
+            if self.dispatch is not None:
+                deferred.deactivate()
+            self.owners.release()
+            if self.claims is not None:
+                self.claims.release_all()
+            if self.references is not None:
+                self.references.release()
+            for archive in self.archives.values():
+                archive.close()
+            self.archives = {}
+        if self.manifest is not None and filepaths is None:
+            self.manifest.save(self.fs_root_directory)
+        summary = self.get_summary()
+        summary["stats"] = self.stats.report()
+        if self.dispatch is not None:
+            summary["deferred"] = self.dispatch.nb_deferred
+        if self.stopped:
+            summary["stopped"] = self.stopped
+            summary["remaining"] = self.count_remaining_files()
+            log.info("batch import stopped (%(stopped)s), %(remaining)s files remaining" % summary)
+        log.info(
+            "batch import finished: %(imported)s imported files, %(errors)s unprocessed files" % summary
+            + " (%(files_per_second).2f files/s, %(bytes_per_second).0f bytes/s)" % summary["stats"]
+        )
+        notify(BatchImportFinishedEvent(getToolByName(self.context, "portal_url").getPortalObject(), summary))
+        return summary
 
-        nb_imports = 0
-        nb_errors = 0
+    def watch(self, watcher):
+        """Import the files the watcher finds ready, micro-batch by micro-batch, yield their summaries.
 
-        excluded_dirs = []
+        The root directory is locked meanwhile, BatchImportError is raised if another import holds it.
+        """
+        if not self.lock.acquire():
+            raise BatchImportError("an import is already running")
+        try:
+            for filepaths in watcher:
+                # start from a fresh view of the database, folders and documents may have changed since
+                transaction.begin()
+                self.folders = utils.FolderResolver(self.context)
+                self.index.clear()
+                self.nb_imports = self.nb_errors = 0
+                self.stats = ImportStats()
+                self.stopped = None
+                if self.dispatch is not None:
+                    self.dispatch.nb_deferred = 0
+                yield self.run(filepaths)
+        finally:
+            self.lock.release()
+
+    def get_summary(self):
+        return {"imported": self.nb_imports, "errors": self.nb_errors, "dry_run": self.dry_run}
+
+    def import_tree(self, filepaths=None):
+        if filepaths is not None:
+            entries = self.list_files(filepaths)
+        elif self.ordering == OLDEST_ORDER:
+            entries = self.walk_oldest_first()
+        elif self.ordering == ROUND_ROBIN_ORDER:
+            entries = self.walk_round_robin()
+        else:
+            entries = self.walk()
+        for entry in Prefetcher(self.prepare_entry, entries, self.prefetch_workers):
+            if self.limit and self.nb_imports + len(self.pending) + self.nb_errors >= self.limit:
+                break
+            self.stopped = self.get_spent_budget()
+            if self.stopped:
+                break
+            self.current_directory = entry.foldername
+            self.import_entry(entry)
+
+    def get_spent_budget(self):
+        if self.max_documents and self.nb_imports + len(self.pending) >= self.max_documents:
+            return "max_documents"
+        if self.max_bytes and self.stats.nb_bytes >= self.max_bytes:
+            return "max_bytes"
+        if self.max_seconds and time.time() - self.stats.started >= self.max_seconds:
+            return "max_seconds"
+        return None
+
+    def count_remaining_files(self):
+        """Count the files left to import in the root directory, archives counting as one file.
+
+        Files the manifest knows as handled and not modified since are not counted.
+        """
+        nb_files = 0
         for basename, dirnames, filenames in os.walk(self.fs_root_directory):
-            # avoid folders beginning with .
-            if os.path.basename(basename).startswith("."):
-                excluded_dirs.append("%s/" % basename)
+            dirnames[:] = [x for x in dirnames if not x.startswith(".")]
+            for filename in filenames:
+                if is_importable(filename) and not self.is_handled(basename, filename, filenames):
+                    nb_files += 1
+        return nb_files
+
+    def is_handled(self, basename, filename, filenames):
+        """Tell if the manifest knows a file of a directory as handled and not modified since."""
+        if self.manifest is None:
+            return False
+        filepaths = [os.path.join(basename, filename)]
+        if filename + ".metadata" in filenames:
+            filepaths.insert(0, filepaths[0] + ".metadata")
+        try:
+            signature = manifest.get_signature(*filepaths)
+        except OSError:
+            # removed meanwhile
+            return True
+        return self.manifest.is_unchanged(filepaths[-1][len(self.fs_root_directory) :], signature)
+
+    def walk(self, top=None):
+        """Yield the entries to import, directory by directory."""
+        for basename, dirnames, filenames in os.walk(top or self.fs_root_directory):
+            # avoid folders beginning with ., without walking them
+            dirnames[:] = [x for x in dirnames if not x.startswith(".")]
+            for entry in self.get_entries(basename, filenames):
+                yield entry
+
+    def walk_oldest_first(self):
+        """Yield the entries to import, the oldest files first.
+
+        Files are sorted from their modification time only, a directory is
+        claimed and its entries read once its first file comes, so that
+        concurrent imports still share the tree.
+        """
+        files = []
+        directory_filenames = {}
+        for basename, dirnames, filenames in os.walk(self.fs_root_directory):
+            dirnames[:] = [x for x in dirnames if not x.startswith(".")]
+            importable_filenames = [x for x in filenames if is_importable(x)]
+            if not importable_filenames:
+                # nothing to claim, its metadata file may be processed
+                list(self.get_entries(basename, filenames))
                 continue
-            if any(basename.startswith(s) for s in excluded_dirs):
+            directory_filenames[basename] = filenames
+            for filename in humansorted(importable_filenames):
+                try:
+                    mtime = os.path.getmtime(os.path.join(basename, filename))
+                except OSError:
+                    mtime = 0
+                files.append((mtime, basename, filename))
+        files.sort(key=lambda x: x[0])
+
+        # entries of the directories being imported, by file or archive name
+        directory_entries = {}
+        nb_remaining_files = collections.Counter(basename for mtime, basename, filename in files)
+        for mtime, basename, filename in files:
+            if basename not in directory_entries:
+                directory_entries[basename] = collections.defaultdict(list)
+                for entry in self.get_entries(basename, directory_filenames.pop(basename)):
+                    entry.last = False
+                    name = os.path.basename(entry.archive.filepath if entry.archive is not None else entry.filepath)
+                    directory_entries[basename][name].append(entry)
+            entries = directory_entries[basename].pop(filename, [])
+            nb_remaining_files[basename] -= 1
+            if not nb_remaining_files[basename]:
+                # released once its last file is imported
+                del directory_entries[basename]
+                if entries:
+                    entries[-1].last = True
+                else:
+                    self.finished_directories.append(basename[len(self.fs_root_directory) :])
+            for entry in entries:
+                yield entry
+
+    def walk_round_robin(self):
+        """Yield the entries to import, taking turns between the top-level directories."""
+        basename, dirnames, filenames = next(os.walk(self.fs_root_directory))
+        walks = [self.get_entries(basename, filenames)]
+        for dirname in humansorted(dirnames):
+            if not dirname.startswith("."):
+                walks.append(self.walk(os.path.join(basename, dirname)))
+        while walks:
+            for walk in list(walks):
+                try:
+                    yield next(walk)
+                except StopIteration:
+                    walks.remove(walk)
+
+    def list_files(self, filepaths):
+        """Yield the entries of the given files, relative to the root directory."""
+        directories = collections.OrderedDict()
+        for filepath in filepaths:
+            dirname, filename = os.path.split(filepath)
+            directories.setdefault(dirname, []).append(filename)
+        for dirname, filenames in directories.items():
+            for entry in self.get_entries(os.path.join(self.fs_root_directory, dirname), filenames):
+                yield entry
+
+    def get_entries(self, basename, filenames):
+        """Yield the entries of files of a directory."""
+        metadata_filenames = [x for x in filenames if x.endswith(".metadata")]
+        other_filenames = [x for x in filenames if is_importable(x)]
+        archive_filenames = [x for x in other_filenames if archives.is_archive(x)]
+        other_filenames = [x for x in other_filenames if not archives.is_archive(x)]
+        foldername = basename[len(self.fs_root_directory) :]
+        if not metadata_filenames and not other_filenames and not archive_filenames:
+            if not self.dry_run:
+                self.finish_directory_metadata(basename)
+            return
+        if self.folders.resolve(foldername) is None:
+            log.warning("error importing %s (directory structure mismatch)" % foldername)
+            self.nb_errors += len(other_filenames) + len(archive_filenames)
+            self.fail_directory(basename, filenames, "directory structure mismatch")
+            return
+        if self.claims is not None and not self.claims.claim(foldername):
+            log.info("skipping %s, already claimed by another import" % foldername)
+            return
+
+        try:
+            directory_metadata = read_directory_metadata(basename) or {}
+        except MetadataError as e:
+            log.warning("error importing %s (invalid metadata, %s)" % (foldername, e))
+            self.nb_errors += len(other_filenames) + len(archive_filenames)
+            self.fail_directory(basename, filenames, "invalid metadata, %s" % e)
+            return
+
+        entries = []
+        # first pass, handle metadata files
+        paired_filenames = set()
+        other_filenames_set = set(other_filenames)
+        for filename in humansorted(metadata_filenames):
+            imported_filename = os.path.splitext(filename)[0]
+            if imported_filename not in other_filenames_set:
+                log.warning("error importing %s (no file for this metadata file)" % os.path.join(foldername, filename))
                 continue
-            metadata_filenames = [x for x in filenames if x.endswith(".metadata")]
-            other_filenames = [x for x in filenames if not x.endswith(".metadata") and not x.startswith(".")]
+            entries.append(
+                ImportEntry(foldername, os.path.join(basename, imported_filename), os.path.join(basename, filename))
+            )
+            paired_filenames.add(imported_filename)
 
-            # first pass, handle metadata files
-            for filename in humansorted(metadata_filenames):
-                metadata_filepath = os.path.join(basename, filename)
-                foldername = basename[len(self.fs_root_directory) :]
+        # second pass, handle other files, creating individual documents
+        for filename in humansorted(other_filenames):
+            if filename not in paired_filenames:
+                entry = ImportEntry(foldername, os.path.join(basename, filename))
+                # from the metadata file of the directory, if any
+                entry.metadata = directory_metadata.get(filename)
+                entries.append(entry)
+        # grouped by owner, when known, so that consecutive documents share the security context
+        entries.sort(key=lambda entry: (entry.metadata or {}).get("owner") or u"")
 
-                metadata = json.load(file(metadata_filepath))
+        # third pass, handle archives, whose files are imported as files of the directory
+        for filename in humansorted(archive_filenames):
+            entries.extend(self.get_archive_entries(foldername, os.path.join(basename, filename)))
 
-                imported_filename = os.path.splitext(filename)[0]
-                filepath = os.path.join(basename, imported_filename)
+        if self.paths:
+            entries = [entry for entry in entries if self.is_selected(entry.filepath)]
 
-                try:
-                    self.import_one(filepath, foldername, metadata)
-                except BatchImportError as e:
-                    log.warning("error importing %s (%s)" % (os.path.join(foldername, filename), str(e)))
-                    nb_errors += 1
+        if entries:
+            entries[-1].last = True
+            for entry in entries:
+                yield entry
+        else:
+            self.finished_directories.append(foldername)
+
+    def fail_directory(self, basename, filenames, error):
+        """Register the files of a directory that cannot be imported at all."""
+        for filename in filenames:
+            if not filename.startswith(".") and filename not in METADATA_FILENAMES:
+                self.failed.append(((os.path.join(basename, filename),), None, error))
+
+    def finish_directory_metadata(self, basename):
+        """Process the metadata file of a directory once there is nothing else to import in it."""
+        filepaths = [os.path.join(basename, x) for x in METADATA_FILENAMES if os.path.exists(os.path.join(basename, x))]
+        if filepaths and all(x.startswith(".") or x in METADATA_FILENAMES for x in os.listdir(basename)):
+            for filepath in filepaths:
+                self.mark_as_processed(filepath)
+
+    def get_archive_entries(self, foldername, filepath):
+        """Return the entries of the files of an archive not imported yet."""
+        try:
+            archive = self.get_archive(filepath)
+        except archives.ArchiveError as e:
+            log.warning("error importing %s (%s)" % (filepath[len(self.fs_root_directory) :], e))
+            self.nb_errors += 1
+            self.failed.append(((filepath,), None, str(e)))
+            return []
+        remaining_entries = archive.get_remaining_entries()
+        if not remaining_entries and not self.dry_run:
+            # its files were all imported by a previous run
+            self.finish_archive(archive)
+        entries = []
+        for name, metadata_name in remaining_entries:
+            entry = ImportEntry(
+                "/".join(part for part in foldername.split("/") + name.split("/")[:-1] if part),
+                archive.get_path(name),
+                metadata_name and archive.get_path(metadata_name),
+                archive=archive,
+            )
+            entry.directory = foldername
+            entries.append(entry)
+        return entries
+
+    def get_archive(self, filepath):
+        if filepath not in self.archives:
+            self.archives[filepath] = archives.Archive(filepath)
+        return self.archives[filepath]
+
+    def finish_archive(self, archive):
+        """Process an archive whose files are all imported."""
+        archive.close()
+        self.archives.pop(archive.filepath, None)
+        self.mark_as_processed(archive.filepath)
+        if self.processed_fs_root_directory != self.fs_root_directory and os.path.exists(archive.progress_filepath):
+            os.remove(archive.progress_filepath)
+
+    def is_selected(self, filepath):
+        """Tell if a file matches one of the paths given to restrict the import."""
+        return utils.pathMatches(filepath[len(self.fs_root_directory) :], self.paths)
+
+    def prepare_entry(self, entry):
+        """Read what is needed to import an entry, possibly in a prefetching thread.
+
+        Errors are kept on the entry, so that it fails alone once imported.
+        """
+        with self.stats.timer("read"):
+            try:
+                return self.read_entry(entry)
+            except ValueError as e:
+                entry.error = "invalid metadata, %s" % e
+            except Exception as e:
+                entry.error = "cannot read file, %s" % e
+            return entry
+
+    def read_entry(self, entry):
+        if self.manifest is not None and os.path.exists(entry.filepath):
+            entry.signature = manifest.get_signature(*entry.filepaths)
+            entry.unchanged = self.manifest.is_unchanged(entry.filepath[len(self.fs_root_directory) :], entry.signature)
+            if entry.unchanged:
+                return entry
+        if entry.metadata_filepath and entry.archive is not None:
+            entry.metadata = json.loads(entry.archive.read(entry.archive.get_name(entry.metadata_filepath)))
+        elif entry.metadata_filepath:
+            with open(entry.metadata_filepath) as fd:
+                entry.metadata = json.load(fd)
+        if self.prefetch_workers and not self.hardlink_blobs and os.path.exists(entry.filepath):
+            # bring the file in the page cache, it will be copied in its blob right after
+            with open(entry.filepath, "rb") as fd:
+                while fd.read(utils.BLOB_CHUNK_SIZE):
+                    pass
+        return entry
+
+    def import_entry(self, entry):
+        if not entry.unchanged:
+            self.import_file(entry)
+        if entry.last:
+            self.finished_directories.append(entry.directory)
+
+    def import_file(self, entry, auto_commit=True):
+        """Import a file in a savepoint of its own, so that its errors leave the batch intact.
+
+        Without auto_commit, the batch is not committed when full, the caller commits it.
+        """
+        if entry.error is not None:
+            self.fail(entry, entry.error)
+            return
+        for attempt in range(self.conflict_retries + 1):
+            savepoint = self.savepoint()
+            try:
+                document = self.import_one(entry.filepath, entry.foldername, entry.metadata, archive=entry.archive)
+            except BatchImportError as e:
+                self.rollback(savepoint)
+                self.fail(entry, str(e))
+            except ConflictError as e:
+                self.rollback(savepoint)
+                if attempt < self.conflict_retries:
+                    self.wait_after_conflict(attempt)
+                    continue
+                # not recorded as failed, the file is imported again by the next run
+                log.warning("conflict importing %s (%s)" % (entry.filepaths[0], e))
+                self.nb_errors += 1
+            except Exception as e:
+                log.exception("unexpected error importing %s" % entry.filepaths[0])
+                self.rollback(savepoint)
+                self.fail(entry, str(e))
+            else:
+                if self.dry_run:
+                    self.nb_imports += 1
                 else:
-                    self.mark_as_processed(metadata_filepath)
-                    self.mark_as_processed(filepath)
-                    nb_imports += 1
+                    self.batch_entries.append(entry)
+                    self.add_to_batch(document, entry.filepaths, entry.signature, auto_commit=auto_commit)
+            return
 
-                other_filenames.remove(imported_filename)
+    def fail(self, entry, error):
+        filename = os.path.basename(entry.filepaths[0])
+        log.warning("error importing %s (%s)" % (os.path.join(entry.foldername, filename), error))
+        self.nb_errors += 1
+        self.failed.append((entry.filepaths, entry.signature, error))
 
-            # second pass, handle other files, creating individual documents
-            for filename in humansorted(other_filenames):
-                filepath = os.path.join(basename, filename)
-                foldername = basename[len(self.fs_root_directory) :]
-                try:
-                    self.import_one(filepath, foldername)
-                except BatchImportError as e:
-                    log.warning("error importing %s (%s)" % (os.path.join(foldername, filename), str(e)))
-                    nb_errors += 1
+    def savepoint(self):
+        queue_state = self.indexing_queue.savepoint() if self.indexing_queue is not None else None
+        references_state = self.references.savepoint() if self.references is not None else None
+        return (transaction.savepoint(optimistic=True), self.index.savepoint(), queue_state, references_state)
+
+    def rollback(self, savepoint):
+        savepoint, index_state, queue_state, references_state = savepoint
+        savepoint.rollback()
+        # the documents of the rolled back savepoint do not exist anymore
+        self.index.rollback(index_state)
+        if queue_state is not None:
+            self.indexing_queue.rollback(queue_state)
+        if references_state is not None:
+            # the numbers of the rolled back document are handed out again
+            self.references.rollback(references_state)
+
+    def wait_after_conflict(self, attempt):
+        # with jitter, so that conflicting imports do not retry in step
+        with self.stats.timer("conflict"):
+            time.sleep(CONFLICT_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5))
+
+    def add_to_batch(self, document, filepaths, signature=None, auto_commit=True):
+        """Register an imported document, committing when the batch is full, with auto_commit.
+
+        Files are only moved once the transaction holding their document has
+        been committed, so an aborted batch leaves them in place for the next run.
+        """
+        self.pending.append(("/".join(document.getPhysicalPath()), filepaths, signature))
+        self.created.append(aq_base(document))
+        if not auto_commit:
+            return
+        high_water = self.get_high_water()
+        if high_water:
+            log.info("%s reached, committing a batch of %s documents early" % (high_water, len(self.pending)))
+            self.commit()
+            self.context._p_jar.cacheMinimize()
+            if high_water in self.get_reached_high_water():
+                # e.g. the process memory is seldom given back, committing early would not help anymore
+                log.warning("%s still reached after emptying the object cache, no more early commits" % high_water)
+                self.latched_high_water.add(high_water)
+        elif len(self.pending) >= self.batch_size:
+            self.commit()
+
+    def get_high_water(self):
+        """Return the first high-water mark reached, leaving aside latched ones."""
+        reached = self.get_reached_high_water()
+        # re-armed once usage drops below them
+        self.latched_high_water &= set(reached)
+        for high_water in reached:
+            if high_water not in self.latched_high_water:
+                return high_water
+        return None
+
+    def get_reached_high_water(self):
+        reached = []
+        if self.max_cache_objects and self.context._p_jar._cache.cache_non_ghost_count >= self.max_cache_objects:
+            reached.append("max_cache_objects")
+        if self.max_memory:
+            rss = utils.get_rss()
+            if rss is not None and rss >= self.max_memory * 1024 * 1024:
+                reached.append("max_memory")
+        return reached
+
+    def commit(self):
+        """Commit the current batch and move its files to the processed directory."""
+        if self.pending or self.failed:
+            self.commit_pending()
+        if self.claims is not None:
+            for foldername in self.finished_directories:
+                self.claims.release(foldername)
+            self.claims.refresh()
+        self.lock.refresh()
+        self.finished_directories = []
+        if self.progress is not None:
+            self.progress(self.get_summary())
+
+    def commit_pending(self, attempt=0):
+        """Commit the current batch.
+
+        On conflicts, its documents are imported again, each one in a
+        transaction of its own, so that a conflicting document does not
+        hold back the others.
+        """
+        pending, self.pending = self.pending, []
+        failed, self.failed = self.failed, []
+        created, self.created = self.created, []
+        entries, self.batch_entries = self.batch_entries, []
+        self.write_journal(pending)
+        try:
+            if self.references is not None:
+                self.references.flush()
+            if self.indexing_queue is not None:
+                with self.stats.timer("index"):
+                    self.indexing_queue.process()
+            with self.stats.timer("commit"):
+                transaction.commit()
+        except ConflictError:
+            self.abort_pending()
+            if attempt < self.conflict_retries:
+                log.info("conflict committing a batch of %s documents, importing them one by one" % len(pending))
+                self.failed = failed
+                self.wait_after_conflict(attempt)
+                for entry in entries:
+                    # committed here, with the attempt number, so that retries stay bounded
+                    self.import_file(entry, auto_commit=False)
+                    if self.pending:
+                        self.commit_pending(attempt + 1)
+                return
+            log.warning("conflict committing a batch of %s documents, they will be imported again" % len(pending))
+            self.nb_errors += len(pending)
+            return
+        except Exception:
+            log.exception("error committing a batch of %s documents, they will be imported again" % len(pending))
+            self.abort_pending()
+            self.nb_errors += len(pending)
+            return
+        self.index.commit()
+        self.release_memory(created)
+        for document_path, filepaths, signature in pending:
+            self.mark_as_imported(filepaths, signature)
+        if self.quarantine_fs_root_directory:
+            for filepaths, signature, error in failed:
+                self.quarantine(filepaths, error)
+        for archive in list(self.archives.values()):
+            if archive.is_complete():
+                self.finish_archive(archive)
+        os.remove(self.journal_filepath)
+        self.nb_imports += len(pending)
+        if self.manifest is not None:
+            for filepaths, signature, error in failed:
+                if signature is not None and not self.quarantine_fs_root_directory:
+                    self.manifest.set(filepaths[-1][len(self.fs_root_directory) :], signature, manifest.ERROR)
+            self.manifest.flush()
+
+    def abort_pending(self):
+        transaction.abort()
+        self.index.clear()
+        if self.indexing_queue is not None:
+            self.indexing_queue.clear()
+        if self.references is not None:
+            self.references.clear()
+        os.remove(self.journal_filepath)
+
+    def release_memory(self, documents):
+        """Turn committed documents and their files back into ghosts, then shrink the object cache."""
+        for document in documents:
+            for obj in document.objectValues():
+                aq_base(obj)._p_deactivate()
+            document._p_deactivate()
+        self.context._p_jar.cacheGC()
+
+    def mark_as_imported(self, filepaths, signature=None):
+        if self.manifest is not None:
+            path = filepaths[-1][len(self.fs_root_directory) :]
+            if self.processed_fs_root_directory == self.fs_root_directory:
+                self.manifest.set(path, signature, manifest.IMPORTED)
+            else:
+                self.manifest.discard(path)
+        for filepath in filepaths:
+            self.mark_as_processed(filepath)
+
+    def quarantine(self, filepaths, error):
+        """Move the files of a document that cannot be imported to the quarantine, with an error record."""
+        paths = []
+        for filepath in filepaths:
+            archive_filepath, name = archives.split_path(filepath)
+            if name is None:
+                path = filepath[len(self.fs_root_directory) :]
+            else:
+                # a file of an archive goes where it would be if the archive was a directory
+                archive = self.get_archive(archive_filepath)
+                name = archive.get_name(filepath)
+                path = os.path.join(os.path.dirname(archive_filepath[len(self.fs_root_directory) :]), *name.split("/"))
+            quarantined_filepath = os.path.join(self.quarantine_fs_root_directory, path)
+            try:
+                if not os.path.exists(os.path.dirname(quarantined_filepath)):
+                    os.makedirs(os.path.dirname(quarantined_filepath))
+                if name is None:
+                    os.rename(filepath, quarantined_filepath)
                 else:
-                    self.mark_as_processed(filepath)
-                    nb_imports += 1
+                    with archive.lock:
+                        stream = archive.open(name)
+                        try:
+                            with open(quarantined_filepath, "wb") as fd:
+                                shutil.copyfileobj(stream, fd, utils.BLOB_CHUNK_SIZE)
+                        finally:
+                            stream.close()
+                    archive.mark_as_done(name)
+            except (IOError, OSError) as e:
+                log.warning("cannot quarantine %s (%s)" % (path, e))
+                continue
+            paths.append(path)
+        if paths:
+            quarantine.write_error_record(self.quarantine_fs_root_directory, paths, error)
+            log.info("%s quarantined (%s)" % (paths[-1], error))
+
+    def write_journal(self, pending):
+        """Keep track of the files of a batch while it is being committed."""
+        with open(self.journal_filepath, "w") as fd:
+            for document_path, filepaths, signature in pending:
+                fd.write(json.dumps({"document": document_path, "files": filepaths}) + "\n")
 
-        return "OK (%s imported files, %s unprocessed files)" % (nb_imports, nb_errors)
+    def recover_journal(self):
+        """Finish the moves of a batch interrupted between its commit and its moves."""
+        portal = getToolByName(self.context, "portal_url").getPortalObject()
+        for journal_filepath in glob.glob(os.path.join(self.fs_root_directory, JOURNAL_FILENAME + "*")):
+            if self.claims is not None and not self.claims.is_stale(journal_filepath):
+                # may belong to an import running on another ZEO client
+                continue
+            for line in open(journal_filepath):
+                entry = json.loads(line)
+                if portal.unrestrictedTraverse(entry["document"].encode("utf8"), None) is None:
+                    # the batch was never committed, its files will be imported again
+                    continue
+                for filepath in entry["files"]:
+                    filepath = filepath.encode("utf8")
+                    if os.path.exists(filepath) or archives.split_path(filepath)[1] is not None:
+                        self.mark_as_processed(filepath)
+            os.remove(journal_filepath)
 
     def mark_as_processed(self, filepath):
+        archive_filepath, name = archives.split_path(filepath)
+        if name is not None:
+            # the archive is processed once all its files are
+            archive = self.get_archive(archive_filepath)
+            archive.mark_as_done(archive.get_name(filepath))
+            return
         # if the processed folder is the same as the input folder, we dont move files
         if self.processed_fs_root_directory == self.fs_root_directory:
             return
@@ -129,11 +1005,9 @@ class BatchImporter(BrowserView):
         os.rename(filepath, processed_filepath)
 
     def get_folder(self, foldername):
-        folder = getToolByName(self.context, "portal_url").getPortalObject()
-        for part in foldername.split("/"):
-            if not part:
-                continue
-            folder = getattr(folder, part)
+        folder = self.folders.resolve(foldername)
+        if folder is None:
+            raise AttributeError(foldername)
         return folder
 
     def convertTitleToId(self, title):
@@ -142,28 +1016,90 @@ class BatchImporter(BrowserView):
         newid = queryUtility(IIDNormalizer).normalize(title)
         return newid
 
-    def import_one(self, filepath, foldername, metadata=None):
+    def import_one(self, filepath, foldername, metadata=None, archive=None):
         try:
             folder = self.get_folder(foldername)
         except AttributeError:
             raise BatchImportError("directory structure mismatch")
 
         filename = os.path.basename(filepath)
-        code, filename = filename.split("-", 1)
-        portal_type = self.code_to_type_mapping.get(code)
-        if not portal_type:
-            raise BatchImportError(u"no portal type associated to this code '%s'" % code)
+        routed = self.router.route(foldername, filename)
+        if routed is None:
+            raise BatchImportError(u"no portal type associated to this code '%s'" % filename.split("-", 1)[0])
+        route, filename = routed
+        portal_type = route.portal_type
 
         title = os.path.splitext(filename)[0]
-        document_id = self.convertTitleToId(title)
-        if metadata is None:
-            metadata = {"title": title}
+        with self.stats.timer("normalize"):
+            document_id = self.convertTitleToId(title)
+        # the metadata of the entry must be left intact for retries
+        file_metadata = metadata
+        metadata = dict(route.metadata)
+        metadata.update(file_metadata if file_metadata is not None else {"title": title})
+        owner = metadata.pop("owner", None) or route.owner
+
+        with self.stats.timer("duplicate_check"):
+            if self.index.has_id(folder, document_id):
+                raise BatchImportError("document already exists")
+
+        if owner is not None and self.owners.get_user(owner) is None:
+            raise BatchImportError(u"unknown owner '%s'" % owner)
+
+        if self.dry_run:
+            self.index.add(folder, document_id, portal_type)
+            return None
 
-        if hasattr(folder, document_id):
-            raise BatchImportError("document already exists")
+        hasher = hashlib.sha256() if self.hashes is not None else None
+        with self.stats.timer("blob"):
+            if archive is not None:
+                with archive.lock:
+                    stream = archive.open(archive.get_name(filepath))
+                    try:
+                        document_file = utils.createBlobFileFromStream(stream, unicode(filename), hasher=hasher)
+                    finally:
+                        stream.close()
+            else:
+                document_file = utils.createBlobFile(
+                    filepath, unicode(filename), link=self.hardlink_blobs, hasher=hasher
+                )
+        existing_document = None
+        if hasher is not None:
+            with self.stats.timer("duplicate_check"):
+                existing_document = self.hashes.get_document(hasher.hexdigest())
+            if existing_document is not None:
+                document_file = self.handle_duplicate_content(existing_document, document_file)
+        document, version = utils.createDocument(
+            self,
+            folder,
+            portal_type,
+            document_id,
+            document_file,
+            mainfile_type=route.mainfile_type,
+            owner=owner,
+            metadata=metadata,
+            index=self.index,
+            references=self.references,
+            stats=self.stats,
+            owners=self.owners,
+        )
+        if hasher is not None and existing_document is None:
+            self.hashes.set(hasher.hexdigest(), document)
+        self.stats.add_file(document_file.getSize())
+        return document
 
-        document_file = NamedBlobFile(file(filepath).read(), filename=unicode(filename))
-        utils.createDocument(self, folder, portal_type, document_id, document_file, metadata=metadata)
+    def handle_duplicate_content(self, existing_document, document_file):
+        """Apply the policy for a file whose content was already imported, return the file to import."""
+        existing_path = "/".join(existing_document.getPhysicalPath())
+        if self.duplicate_content_policy == hashes.SKIP:
+            raise BatchImportError("same content as %s" % existing_path)
+        if self.duplicate_content_policy == hashes.LINK:
+            main_file = hashes.get_main_file(existing_document)
+            if main_file is not None:
+                linked_file = hashes.link_blob_file(main_file.file, document_file.filename)
+                if linked_file is not None:
+                    log.info("linking the file of %s" % existing_path)
+                    return linked_file
+        return document_file
 
 
 class ControlPanelEditForm(controlpanel.RegistryEditForm):
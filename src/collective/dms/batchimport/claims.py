@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+import errno
+import hashlib
+import json
+import logging
+import os
+import socket
+import thread
+import time
+
+
+log = logging.getLogger("collective.dms.batchimport")
+
+CLAIMS_DIRNAME = ".batchimport-claims"
+
+
+def get_worker_id():
+    """Identify the current import, several of them can run in the same process."""
+    return "%s-%s-%s" % (socket.gethostname(), os.getpid(), thread.get_ident())
+
+
+class DirectoryClaims(object):
+    """Directories of the import tree claimed by the current import.
+
+    A claim is a lock file created atomically in a hidden directory of the
+    root directory, so that imports running on other ZEO clients skip the
+    directories imported here. A claim that has not been refreshed for more
+    than timeout seconds is considered abandoned and can be taken over.
+    """
+
+    def __init__(self, fs_root_directory, timeout=3600, worker_id=None):
+        self.claims_directory = os.path.join(fs_root_directory, CLAIMS_DIRNAME)
+        self.timeout = timeout
+        self.worker_id = worker_id or get_worker_id()
+        self.claimed = {}
+        if not os.path.exists(self.claims_directory):
+            try:
+                os.makedirs(self.claims_directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def get_lock_path(self, foldername):
+        if isinstance(foldername, unicode):
+            foldername = foldername.encode("utf8")
+        return os.path.join(self.claims_directory, "%s.lock" % hashlib.sha1(foldername).hexdigest())
+
+    def is_stale(self, lock_path):
+        try:
+            return time.time() - os.path.getmtime(lock_path) > self.timeout
+        except OSError:
+            return True
+
+    def claim(self, foldername):
+        """Try to claim a directory, return False if another import holds it."""
+        if foldername in self.claimed:
+            return True
+        lock_path = self.get_lock_path(foldername)
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            if not self.is_stale(lock_path) or not self.take_over(lock_path):
+                return False
+            return self.claim(foldername)
+        os.write(fd, json.dumps({"worker": self.worker_id, "directory": foldername, "time": time.time()}))
+        os.close(fd)
+        self.claimed[foldername] = lock_path
+        return True
+
+    def take_over(self, lock_path):
+        """Remove an abandoned claim, only one of the competing imports succeeds."""
+        stale_path = "%s.%s" % (lock_path, self.worker_id)
+        try:
+            os.rename(lock_path, stale_path)
+        except OSError:
+            return False
+        if not self.is_stale(stale_path):
+            # another import took it over in the meantime, give it back
+            try:
+                os.link(stale_path, lock_path)
+            except OSError:
+                pass
+            os.remove(stale_path)
+            return False
+        log.warning("taking over abandoned claim %s" % lock_path)
+        os.remove(stale_path)
+        return True
+
+    def refresh(self):
+        """Keep the claims of a long running import alive."""
+        for lock_path in self.claimed.values():
+            try:
+                os.utime(lock_path, None)
+            except OSError:
+                log.warning("claim %s has been lost" % lock_path)
+
+    def release(self, foldername):
+        lock_path = self.claimed.pop(foldername, None)
+        if lock_path is not None and os.path.exists(lock_path):
+            os.remove(lock_path)
+
+    def release_all(self):
+        for foldername in list(self.claimed):
+            self.release(foldername)
+
+
+# claimed for the whole root directory, never the name of one of its directories
+IMPORT_CLAIM = "/"
+
+
+class ImportLock(object):
+    """Lock held by the running import of a root directory.
+
+    It is a claim of the whole root directory, so that a single import runs
+    at a time whichever process or ZEO client runs it. It must be refreshed
+    by long imports, and is taken over once abandoned for timeout seconds.
+    """
+
+    def __init__(self, fs_root_directory, timeout=3600):
+        self.claims = DirectoryClaims(fs_root_directory, timeout)
+
+    def acquire(self):
+        """Try to take the lock, return False if another import holds it."""
+        return self.claims.claim(IMPORT_CLAIM)
+
+    def refresh(self):
+        self.claims.refresh()
+
+    def release(self):
+        self.claims.release(IMPORT_CLAIM)
+
+
+class SharedImportLock(ImportLock):
+    """Lock of the imports sharing a root directory, each one claiming the directories it imports.
+
+    Any number of them run at the same time, they are only kept from
+    running while an import holds the ImportLock of the root directory.
+    """
+
+    def acquire(self):
+        lock_path = self.claims.get_lock_path(IMPORT_CLAIM)
+        return not os.path.exists(lock_path) or self.claims.is_stale(lock_path)
+
+    def refresh(self):
+        pass
+
+    def release(self):
+        pass
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""Event subscribers deferred during bulk imports.
+
+While an import runs in the current thread, the object event handlers
+given by their dotted name are not called: a task is queued instead in an
+annotation of the portal, and replayed later by drain(), e.g. by
+``bin/instance batchimport --drain``, possibly in several processes at once.
+Handlers are replayed with a new event of the same type, created, added or
+modified; the handlers of other events are never deferred.
+"""
+from Acquisition import aq_parent
+from BTrees.LOBTree import LOBTree
+from plone.uuid.interfaces import IUUID
+from Products.CMFCore.utils import getToolByName
+from ZODB.POSException import ConflictError
+from zope.annotation.interfaces import IAnnotations
+from zope.component.registry import Components
+from zope.dottedname.resolve import resolve
+from zope.interface import providedBy
+from zope.interface.interfaces import IObjectEvent
+from zope.lifecycleevent import ObjectAddedEvent
+from zope.lifecycleevent import ObjectCreatedEvent
+from zope.lifecycleevent import ObjectModifiedEvent
+
+import logging
+import random
+import threading
+import time
+import transaction
+import zlib
+
+
+log = logging.getLogger("collective.dms.batchimport")
+
+ANNOTATION_KEY = "collective.dms.batchimport.deferred"
+FAILED_ANNOTATION_KEY = "collective.dms.batchimport.deferred.failed"
+
+REPLAYABLE_EVENTS = (ObjectCreatedEvent, ObjectAddedEvent, ObjectModifiedEvent)
+
+_local = threading.local()
+
+
+def get_dotted_name(handler):
+    return "%s.%s" % (getattr(handler, "__module__", None), getattr(handler, "__name__", None))
+
+
+def get_queue(portal, key=ANNOTATION_KEY):
+    annotations = IAnnotations(portal)
+    if key not in annotations:
+        annotations[key] = LOBTree()
+    return annotations[key]
+
+
+def make_event(event_class, obj):
+    if issubclass(event_class, ObjectAddedEvent):
+        return event_class(obj, aq_parent(obj), obj.getId())
+    return event_class(obj)
+
+
+class DeferredDispatch(object):
+    """Object event handlers deferred, or suppressed, by dotted name."""
+
+    def __init__(self, portal, deferred=(), suppressed=()):
+        self.portal = portal
+        self.deferred = set(deferred)
+        self.suppressed = set(suppressed)
+        self.nb_deferred = 0
+
+    def dispatch(self, handler, obj, event):
+        name = get_dotted_name(handler)
+        if name in self.suppressed:
+            return
+        if name in self.deferred and type(event) in REPLAYABLE_EVENTS:
+            uid = IUUID(obj, None)
+            event_uid = IUUID(event.object, None)
+            if uid is not None and event_uid is not None:
+                self.defer(name, uid, event_uid, get_dotted_name(type(event)))
+                return
+        handler(obj, event)
+
+    def defer(self, name, uid, event_uid, event_name):
+        queue = get_queue(self.portal)
+        # ordered by time, random low digits avoid conflicts between concurrent imports
+        key = int(time.time() * 1000000) * 1000 + random.randint(0, 999)
+        while key in queue:
+            key += 1
+        queue[key] = (uid, event_uid, event_name, name)
+        self.nb_deferred += 1
+
+
+def get_dispatch():
+    return getattr(_local, "dispatch", None)
+
+
+def activate(dispatch):
+    _local.dispatch = dispatch
+
+
+def deactivate():
+    _local.dispatch = None
+
+
+def get_object(catalog, uid):
+    brains = catalog.unrestrictedSearchResults(UID=uid)
+    if not brains:
+        return None
+    return brains[0]._unrestrictedGetObject()
+
+
+def drain(portal, worker=0, workers=1, batch_size=10):
+    """Replay the deferred handlers, return the number of replayed tasks.
+
+    Several workers can drain the queue at the same time, each one replaying
+    the tasks of its share of the objects, in their order.
+    """
+    queue = get_queue(portal)
+    catalog = getToolByName(portal, "portal_catalog")
+    nb_replayed = 0
+    for key in list(queue.keys()):
+        task = queue.get(key)
+        if task is None:
+            continue
+        uid, event_uid, event_name, name = task
+        if (zlib.crc32(uid) & 0xFFFFFFFF) % workers != worker:
+            continue
+        obj = get_object(catalog, uid)
+        event_object = obj if event_uid == uid else get_object(catalog, event_uid)
+        if obj is None or event_object is None:
+            log.warning("%s not replayed, its object does not exist anymore" % name)
+        else:
+            savepoint = transaction.savepoint(optimistic=True)
+            try:
+                resolve(name)(obj, make_event(resolve(event_name), event_object))
+            except ConflictError:
+                raise
+            except Exception:
+                log.exception("error replaying %s on %s" % (name, "/".join(obj.getPhysicalPath())))
+                savepoint.rollback()
+                get_queue(portal, FAILED_ANNOTATION_KEY)[key] = task
+        del queue[key]
+        nb_replayed += 1
+        if nb_replayed % batch_size == 0:
+            transaction.commit()
+            log.info("%s deferred tasks replayed" % nb_replayed)
+    transaction.commit()
+    return nb_replayed
+
+
+_subscribers = Components.subscribers
+
+
+def _dispatched_subscribers(self, objects, provided):
+    dispatch = get_dispatch()
+    if dispatch is None or provided is not None or len(objects) != 2 or not IObjectEvent.providedBy(objects[1]):
+        return _subscribers(self, objects, provided)
+    for handler in self.adapters.subscriptions(map(providedBy, objects), None):
+        dispatch.dispatch(handler, *objects)
+    return ()
+
+
+Components.subscribers = _dispatched_subscribers
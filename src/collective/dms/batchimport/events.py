@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+from collective.dms.batchimport.interfaces import IBatchImportFinishedEvent
+from zope.component.interfaces import ObjectEvent
+from zope.interface import implementer
+
+
+@implementer(IBatchImportFinishedEvent)
+class BatchImportFinishedEvent(ObjectEvent):
+    def __init__(self, object, report):
+        super(BatchImportFinishedEvent, self).__init__(object)
+        self.report = report
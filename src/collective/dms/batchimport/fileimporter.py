@@ -6,7 +6,6 @@ from plone.directives import form
 from plone.i18n.normalizer.interfaces import IIDNormalizer
 from plone.namedfile.field import NamedBlobFile
 from plone.namedfile.field import NamedFile
-from Products.CMFCore.utils import getToolByName
 from Products.CMFPlone.interfaces import IPloneSiteRoot
 from zope import schema
 from zope.component import queryUtility
@@ -43,11 +42,9 @@ class ImportFileForm(form.SchemaForm):
     grok.name("fileimport")
 
     def get_folder(self, foldername):
-        folder = getToolByName(self.context, "portal_url").getPortalObject()
-        for part in foldername.split("/"):
-            if not part:
-                continue
-            folder = getattr(folder, part)
+        folder = utils.FolderResolver(self.context).resolve(foldername)
+        if folder is None:
+            raise AttributeError(foldername)
         return folder
 
     def convertTitleToId(self, title):
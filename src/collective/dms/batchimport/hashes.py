@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""Imported documents by the SHA-256 hash of their file.
+
+The index is kept in an annotation of the portal, so that a file whose
+content was already imported, under any name or in any folder, is
+recognized before its document is created.
+"""
+from Acquisition import aq_parent
+from BTrees.OOBTree import OOBTree
+from collective.dms.batchimport import indexing
+from plone.namedfile.file import NamedBlobFile
+from plone.uuid.interfaces import IUUID
+from Products.CMFCore.utils import getToolByName
+from ZODB.interfaces import BlobError
+from zope.annotation.interfaces import IAnnotations
+
+import hashlib
+import logging
+import os
+import transaction
+import uuid
+
+
+log = logging.getLogger("collective.dms.batchimport")
+
+ANNOTATION_KEY = "collective.dms.batchimport.hashes"
+
+# policies for files whose content was already imported
+SKIP = "skip"
+LINK = "link"
+IMPORT = "import"
+
+CHUNK_SIZE = 1 << 16
+
+
+def hash_blob_file(blob_file):
+    hasher = hashlib.sha256()
+    fd = blob_file.open()
+    try:
+        for chunk in iter(lambda: fd.read(CHUNK_SIZE), ""):
+            hasher.update(chunk)
+    finally:
+        fd.close()
+    return hasher.hexdigest()
+
+
+def get_main_file(document, mainfile_type="dmsmainfile"):
+    for version in document.objectValues():
+        if version.portal_type == mainfile_type and getattr(version, "file", None) is not None:
+            return version
+    return None
+
+
+def link_blob_file(blob_file, filename):
+    """Return a new file whose blob is a hard link of the committed blob of blob_file.
+
+    The two files only share their content on disk: blob files are never
+    modified in place, writing to either one gives it a file of its own.
+    Return None if blob_file is not committed yet or cannot be linked.
+    """
+    blob = blob_file._blob
+    blob._p_activate()
+    try:
+        committed_filepath = blob.committed()
+    except BlobError:
+        return None
+    link_path = os.path.join(os.path.dirname(committed_filepath), ".%s.link" % uuid.uuid4().hex)
+    try:
+        os.link(committed_filepath, link_path)
+    except OSError as e:
+        log.warning("cannot link %s, copying it (%s)" % (committed_filepath, e))
+        return None
+    linked_file = NamedBlobFile(filename=filename, contentType=blob_file.contentType)
+    linked_file._blob.consumeFile(link_path)
+    return linked_file
+
+
+class HashIndex(object):
+    """Document UIDs by hash of their main file."""
+
+    def __init__(self, portal):
+        self.portal = portal
+        self.catalog = getToolByName(portal, "portal_catalog")
+
+    @property
+    def hashes(self):
+        annotations = IAnnotations(self.portal)
+        if ANNOTATION_KEY not in annotations:
+            annotations[ANNOTATION_KEY] = OOBTree()
+        return annotations[ANNOTATION_KEY]
+
+    def __len__(self):
+        return len(IAnnotations(self.portal).get(ANNOTATION_KEY, ()))
+
+    def get_document(self, digest):
+        """Return the document imported with this hash, if it still exists."""
+        uid = IAnnotations(self.portal).get(ANNOTATION_KEY, {}).get(digest)
+        if uid is None:
+            return None
+        # documents whose indexing is deferred must be found too
+        indexing.flush()
+        brains = self.catalog.unrestrictedSearchResults(UID=uid)
+        if not brains:
+            return None
+        return brains[0]._unrestrictedGetObject()
+
+    def set(self, digest, document):
+        self.hashes[digest] = IUUID(document)
+
+    def add(self, digest, document):
+        """Add a document if no other one has this hash, return True if added."""
+        if digest in self.hashes:
+            return False
+        self.set(digest, document)
+        return True
+
+
+def backfill(portal, mainfile_type="dmsmainfile", batch_size=100):
+    """Add the documents created before the hash index to it, return the number of added documents."""
+    index = HashIndex(portal)
+    catalog = getToolByName(portal, "portal_catalog")
+    nb_added = 0
+    for number, brain in enumerate(catalog.unrestrictedSearchResults(portal_type=mainfile_type), 1):
+        version = brain._unrestrictedGetObject()
+        if getattr(version, "file", None) is not None:
+            if index.add(hash_blob_file(version.file), aq_parent(version)):
+                nb_added += 1
+        if number % batch_size == 0:
+            transaction.commit()
+            log.info("%s files hashed, %s documents added to the hash index" % (number, nb_added))
+    transaction.commit()
+    return nb_added
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""Catalog indexing postponed during bulk imports.
+
+While a queue is active in the current thread, the catalog operations of
+content objects are recorded by the queue, deduplicated per object, and
+only done when the queue is processed, e.g. once per committed batch.
+"""
+from Products.CMFCore.CMFCatalogAware import CatalogAware
+from Products.CMFCore.utils import getToolByName
+
+import collections
+import threading
+
+
+_local = threading.local()
+
+
+class IndexingQueue(object):
+    """Catalog operations postponed until the queue is processed."""
+
+    def __init__(self, context):
+        self.catalog = getToolByName(context, "portal_catalog")
+        self.clear()
+
+    def clear(self):
+        # physical path -> (object, indexes or None for all of them)
+        self.objects = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.objects)
+
+    def savepoint(self):
+        """Return the state of the queue, to restore along with a transaction savepoint."""
+        return collections.OrderedDict(self.objects)
+
+    def rollback(self, state):
+        self.objects = collections.OrderedDict(state)
+
+    def index(self, obj, idxs=None):
+        key = obj.getPhysicalPath()
+        idxs = set(idxs) if idxs else None
+        if key in self.objects:
+            current_idxs = self.objects[key][1]
+            idxs = None if idxs is None or current_idxs is None else current_idxs | idxs
+        self.objects[key] = (obj, idxs)
+
+    def unindex(self, obj):
+        self.objects.pop(obj.getPhysicalPath(), None)
+        self.catalog.unindexObject(obj)
+
+    def process(self):
+        objects = self.objects
+        self.clear()
+        for obj, idxs in objects.values():
+            if idxs is None:
+                self.catalog.indexObject(obj)
+            else:
+                self.catalog.reindexObject(obj, idxs=list(idxs))
+        return len(objects)
+
+
+class QueuedCatalog(object):
+    """The catalog as seen by content objects while a queue is active."""
+
+    def __init__(self, catalog, queue):
+        self._catalog_tool = catalog
+        self._queue = queue
+
+    def __getattr__(self, name):
+        return getattr(self._catalog_tool, name)
+
+    def indexObject(self, obj):
+        self._queue.index(obj)
+
+    def reindexObject(self, obj, idxs=[], update_metadata=1, uid=None):
+        if uid is not None and uid != "/".join(obj.getPhysicalPath()):
+            return self._catalog_tool.reindexObject(obj, idxs=idxs, update_metadata=update_metadata, uid=uid)
+        self._queue.index(obj, idxs)
+
+    def unindexObject(self, obj):
+        self._queue.unindex(obj)
+
+
+def get_queue():
+    return getattr(_local, "queue", None)
+
+
+def activate(queue):
+    _local.queue = queue
+
+
+def deactivate():
+    _local.queue = None
+
+
+def flush():
+    """Process the active queue, before searching the catalog."""
+    queue = get_queue()
+    if queue is not None:
+        queue.process()
+
+
+_getCatalogTool = CatalogAware._getCatalogTool
+
+
+def _getQueuedCatalogTool(self):
+    catalog = _getCatalogTool(self)
+    queue = get_queue()
+    if catalog is None or queue is None:
+        return catalog
+    return QueuedCatalog(catalog, queue)
+
+
+CatalogAware._getCatalogTool = _getQueuedCatalogTool
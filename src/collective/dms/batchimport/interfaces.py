@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+from zope.component.interfaces import IObjectEvent
+from zope.interface import Attribute
+
+
+class IBatchImportFinishedEvent(IObjectEvent):
+    """A batch import of the site (the event object) has finished."""
+
+    report = Attribute("Summary of the import, with the durations of its stages in 'stats'")
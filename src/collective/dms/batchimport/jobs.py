@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+"""Imports run as background jobs of the Zope process.
+
+A job imports in a thread of its own, with its own database connection,
+as the user who started it. It holds the lock of the root directory, so
+that only one import runs at a time, whichever process or ZEO client runs
+it: a new job is either rejected or queued until the running one is
+finished. Its status is saved in a hidden directory of the root directory
+at each batch, so that ``@@batchimport-status`` reports it from any ZEO
+client without touching the database.
+"""
+from AccessControl.SecurityManagement import getSecurityManager
+from AccessControl.SecurityManagement import newSecurityManager
+from AccessControl.SecurityManagement import noSecurityManager
+from Acquisition import aq_base
+from Acquisition import aq_chain
+from plone.registry.interfaces import IRegistry
+from Products.Five.browser import BrowserView
+from Testing.makerequest import makerequest
+from zope import component
+from zope.component.hooks import setSite
+
+import collections
+import json
+import logging
+import os
+import re
+import threading
+import time
+import transaction
+import uuid
+
+
+log = logging.getLogger("collective.dms.batchimport")
+
+QUEUED = "queued"
+RUNNING = "running"
+FINISHED = "finished"
+FAILED = "failed"
+
+# finished jobs kept for their status
+MAX_JOBS = 20
+
+JOBS_DIRNAME = ".batchimport-jobs"
+
+# seconds between two attempts of a queued job to take the lock
+QUEUE_INTERVAL = 1.0
+
+JOB_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+# job id -> job started by this process, oldest first
+_jobs = collections.OrderedDict()
+
+
+def get_jobs_directory(fs_root_directory):
+    return os.path.join(os.path.normpath(fs_root_directory), JOBS_DIRNAME)
+
+
+def get_status_filepath(fs_root_directory, job_id):
+    return os.path.join(get_jobs_directory(fs_root_directory), "%s.json" % job_id)
+
+
+def read_statuses(fs_root_directory):
+    """Return the saved statuses of the jobs of a root directory, by job id."""
+    statuses = {}
+    jobs_directory = get_jobs_directory(fs_root_directory)
+    if not os.path.isdir(jobs_directory):
+        return statuses
+    for filename in os.listdir(jobs_directory):
+        if not filename.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(jobs_directory, filename)) as fd:
+                status = json.load(fd)
+        except (IOError, ValueError):
+            # removed meanwhile
+            continue
+        statuses[status["job"]] = status
+    return statuses
+
+
+def get_statuses(fs_root_directory):
+    """Return the statuses of the jobs of a root directory, oldest first.
+
+    The statuses of the jobs of this process are up to date, the others are
+    the ones saved by their process at their last batch.
+    """
+    statuses = read_statuses(fs_root_directory)
+    for job in _jobs.values():
+        if job.jobs_directory == get_jobs_directory(fs_root_directory):
+            statuses[job.id] = job.get_status()
+    return sorted(statuses.values(), key=lambda status: status["created"])
+
+
+def get_status(fs_root_directory, job_id):
+    """Return the status of a job, None if it is unknown."""
+    job = _jobs.get(job_id)
+    if job is not None:
+        return job.get_status()
+    if not JOB_ID_PATTERN.match(job_id):
+        return None
+    try:
+        with open(get_status_filepath(fs_root_directory, job_id)) as fd:
+            return json.load(fd)
+    except (IOError, ValueError):
+        return None
+
+
+def get_job(job_id):
+    """Return a job started by this process."""
+    return _jobs.get(job_id)
+
+
+def forget_old_jobs(fs_root_directory):
+    """Remove the statuses of the oldest finished jobs, keeping MAX_JOBS jobs."""
+    for status in get_statuses(fs_root_directory)[:-MAX_JOBS]:
+        if status["finished"] is None:
+            continue
+        _jobs.pop(status["job"], None)
+        try:
+            os.remove(get_status_filepath(fs_root_directory, status["job"]))
+        except OSError:
+            pass
+
+
+class ImportJob(threading.Thread):
+    """An import running in the background, with its progress."""
+
+    def __init__(self, portal, fs_root_directory, lock, options=None, locked=False):
+        super(ImportJob, self).__init__(name="batchimport")
+        self.daemon = True
+        self.id = uuid.uuid4().hex
+        self.db = portal._p_jar.db()
+        self.portal_path = portal.getPhysicalPath()
+        self.jobs_directory = get_jobs_directory(fs_root_directory)
+        self.status_filepath = get_status_filepath(fs_root_directory, self.id)
+        self.user_id = getSecurityManager().getUser().getId()
+        self.options = options or {}
+        self.lock = lock
+        # the lock may have been acquired for the job, otherwise it waits for it
+        self.locked = locked
+        self.state = QUEUED
+        self.created = time.time()
+        self.started = self.finished = None
+        # the running importer, forgotten once finished
+        self.importer = None
+        # its last progress
+        self.progress = {}
+        self.total = None
+        self.summary = None
+        self.error = None
+
+    def run(self):
+        while not self.locked:
+            self.locked = self.lock.acquire()
+            if not self.locked:
+                time.sleep(QUEUE_INTERVAL)
+        self.started = time.time()
+        connection = None
+        try:
+            self.state = RUNNING
+            self.save_status()
+            connection = self.db.open()
+            self.import_files(makerequest(connection.root()["Application"]))
+        except Exception as e:
+            log.exception("error in batch import job %s" % self.id)
+            transaction.abort()
+            self.state = FAILED
+            self.error = str(e)
+        finally:
+            noSecurityManager()
+            setSite(None)
+            if connection is not None:
+                connection.close()
+            self.finished = time.time()
+            self.progress = self.get_progress()
+            self.importer = None
+            self.save_status()
+            self.lock.release()
+
+    def import_files(self, app):
+        from collective.dms.batchimport.batchimport import BatchImporter
+
+        portal = app.unrestrictedTraverse(self.portal_path)
+        setSite(portal)
+        user = None
+        for context in aq_chain(portal):
+            if getattr(aq_base(context), "acl_users", None) is not None:
+                user = context.acl_users.getUserById(self.user_id)
+                if user is not None:
+                    newSecurityManager(None, user.__of__(context.acl_users))
+                    break
+        if user is None:
+            raise ValueError("user '%s' not found" % self.user_id)
+        importer = BatchImporter(portal, app.REQUEST)
+        if not importer.setup(progress=self.save_status, **self.options):
+            raise ValueError("the batch import is not configured")
+        # held by the job, refreshed by the importer at each batch
+        importer.lock = self.lock
+        self.total = importer.count_remaining_files()
+        self.importer = importer
+        self.summary = importer.run()
+        self.state = FINISHED
+
+    def get_progress(self):
+        importer = self.importer
+        if importer is None:
+            return self.progress
+        elapsed = (self.finished or time.time()) - self.started
+        return {
+            "imported": importer.nb_imports,
+            "pending": len(importer.pending),
+            "errors": importer.nb_errors,
+            "directory": importer.current_directory,
+            "total": self.total,
+            "files_per_second": elapsed and importer.stats.nb_files / elapsed,
+            "bytes_per_second": elapsed and importer.stats.nb_bytes / elapsed,
+        }
+
+    def get_status(self):
+        status = {
+            "job": self.id,
+            "state": self.state,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+        }
+        progress = self.get_progress()
+        status.update(progress)
+        if self.state == RUNNING and progress.get("files_per_second"):
+            handled = progress["imported"] + progress["pending"] + progress["errors"]
+            status["eta"] = max(self.total - handled, 0) / progress["files_per_second"]
+        if self.summary is not None:
+            status["summary"] = self.summary
+        if self.error is not None:
+            status["error"] = self.error
+        return status
+
+    def save_status(self, summary=None):
+        """Write the status of the job for the other processes, replacing the previous one at once."""
+        try:
+            if not os.path.exists(self.jobs_directory):
+                os.makedirs(self.jobs_directory)
+            temporary_filepath = "%s.tmp" % self.status_filepath
+            with open(temporary_filepath, "w") as fd:
+                json.dump(self.get_status(), fd)
+            os.rename(temporary_filepath, self.status_filepath)
+        except (IOError, OSError) as e:
+            log.warning("cannot save the status of batch import job %s (%s)" % (self.id, e))
+
+
+def start(importer, options=None, queue=False):
+    """Start an import job for a set up importer, return it, or None if an import is running and it is not queued."""
+    locked = importer.lock.acquire()
+    if not locked and not queue:
+        return None
+    job = ImportJob(importer.context, importer.fs_root_directory, importer.lock, options, locked=locked)
+    _jobs[job.id] = job
+    job.save_status()
+    forget_old_jobs(importer.fs_root_directory)
+    job.start()
+    return job
+
+
+class JobStatus(BrowserView):
+    """Progress of the import jobs of the site, or of the ``job`` one, in json."""
+
+    def __call__(self):
+        from collective.dms.batchimport.batchimport import ISettings
+
+        self.request.response.setHeader("Content-Type", "application/json")
+        settings = component.getUtility(IRegistry).forInterface(ISettings, False)
+        if not settings.fs_root_directory:
+            return json.dumps([])
+        job_id = self.request.get("job")
+        if job_id:
+            status = get_status(settings.fs_root_directory, job_id)
+            if status is None:
+                self.request.response.setStatus(404)
+                return json.dumps({"error": "unknown job %s" % job_id})
+            return json.dumps(status)
+        return json.dumps(get_statuses(settings.fs_root_directory))
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+
+
+log = logging.getLogger("collective.dms.batchimport")
+
+MANIFEST_FILENAME = ".batchimport-manifest"
+
+IMPORTED = "imported"
+ERROR = "error"
+
+
+def get_signature(*filepaths):
+    """Size and modification time identifying the state of a document and its metadata file."""
+    size = 0
+    mtime = 0
+    for filepath in filepaths:
+        stat = os.stat(filepath)
+        size += stat.st_size
+        mtime = max(mtime, stat.st_mtime)
+    return [size, mtime]
+
+
+class ScanManifest(object):
+    """Files already handled by previous imports, with their signature and status.
+
+    The manifest is an append-only log of json lines in the root directory,
+    the last line of a path winning. It is compacted when saved at the end of
+    an import.
+    """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.entries = {}
+        self.changes = []
+        if os.path.exists(filepath):
+            for line in open(filepath):
+                try:
+                    path, signature, status = json.loads(line)
+                except ValueError:
+                    # a line truncated by an interrupted import
+                    continue
+                if status is None:
+                    self.entries.pop(path, None)
+                else:
+                    self.entries[path] = (signature, status)
+
+    def is_unchanged(self, path, signature):
+        """Tell if a file has already been handled and not modified since."""
+        entry = self.entries.get(path)
+        return entry is not None and entry[0] == signature
+
+    def set(self, path, signature, status):
+        self.entries[path] = (signature, status)
+        self.changes.append((path, signature, status))
+
+    def discard(self, path):
+        if self.entries.pop(path, None) is not None:
+            self.changes.append((path, None, None))
+
+    def flush(self):
+        """Append the changes to the manifest."""
+        if not self.changes:
+            return
+        with open(self.filepath, "a") as fd:
+            for change in self.changes:
+                fd.write(json.dumps(change) + "\n")
+        self.changes = []
+
+    def save(self, fs_root_directory):
+        """Rewrite the manifest, forgetting the files that are not there anymore."""
+        self.changes = []
+        tmp_filepath = self.filepath + ".tmp"
+        with open(tmp_filepath, "w") as fd:
+            for path, (signature, status) in sorted(self.entries.items()):
+                if os.path.exists(os.path.join(fs_root_directory, path)):
+                    fd.write(json.dumps((path, signature, status)) + "\n")
+        os.rename(tmp_filepath, self.filepath)
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""Metadata of all the files of a directory, in a single file.
+
+Instead of a ``.metadata`` file per file, a directory can hold a
+``metadata.jsonl`` file, with a json object per line, or a
+``metadata.csv`` file, with a header line; both give the metadata of a
+file by its ``filename``.
+"""
+import csv
+import json
+import os
+
+
+METADATA_FILENAMES = ("metadata.jsonl", "metadata.csv")
+
+
+class MetadataError(Exception):
+    pass
+
+
+def read_jsonl(fd):
+    for number, line in enumerate(fd, 1):
+        if not line.strip():
+            continue
+        try:
+            data = json.loads(line)
+        except ValueError as e:
+            raise MetadataError("line %s: %s" % (number, e))
+        if not isinstance(data, dict):
+            raise MetadataError("line %s: not an object" % number)
+        yield number, data
+
+
+def read_csv(fd):
+    for number, row in enumerate(csv.DictReader(fd), 2):
+        # empty cells leave the default values
+        yield number, dict((key.decode("utf8"), value.decode("utf8")) for key, value in row.items() if value)
+
+
+def read_directory_metadata(dirpath):
+    """Return the metadata of the files of a directory by filename, None if it has no metadata file."""
+    directory_metadata = None
+    for filename, read in zip(METADATA_FILENAMES, (read_jsonl, read_csv)):
+        filepath = os.path.join(dirpath, filename)
+        if not os.path.exists(filepath):
+            continue
+        if directory_metadata is None:
+            directory_metadata = {}
+        with open(filepath, "rb") as fd:
+            try:
+                for number, data in read(fd):
+                    if not data.get("filename"):
+                        raise MetadataError("line %s: no filename" % number)
+                    directory_metadata[data.pop("filename")] = data
+            except csv.Error as e:
+                raise MetadataError("%s: %s" % (filename, e))
+            except MetadataError as e:
+                raise MetadataError("%s, %s" % (filename, e))
+    return directory_metadata
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+from multiprocessing.pool import ThreadPool
+
+import collections
+
+
+class Prefetcher(object):
+    """Apply func to items in worker threads, yielding the results in order.
+
+    Items are consumed and results yielded in the calling thread, at most
+    depth items being prepared in advance. Any work on the ZODB must stay
+    out of func, in the consumer.
+    """
+
+    def __init__(self, func, items, workers=2, depth=None):
+        self.func = func
+        self.items = items
+        self.workers = workers
+        self.depth = depth or workers * 4
+
+    def __iter__(self):
+        if not self.workers:
+            for item in self.items:
+                yield self.func(item)
+            return
+        pool = ThreadPool(self.workers)
+        try:
+            items = iter(self.items)
+            pending = collections.deque()
+            for item in items:
+                pending.append(pool.apply_async(self.func, (item,)))
+                if len(pending) >= self.depth:
+                    break
+            while pending:
+                result = pending.popleft().get()
+                for item in items:
+                    pending.append(pool.apply_async(self.func, (item,)))
+                    break
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""Files that cannot be imported, kept apart until the cause is fixed.
+
+Quarantined files keep their path relative to the root directory; each
+failed document gets a json error record next to its file, e.g.
+``incoming-mails/in-mail.pdf.error``.
+"""
+from collective.dms.batchimport import utils
+
+import datetime
+import json
+import logging
+import os
+
+
+log = logging.getLogger("collective.dms.batchimport")
+
+ERROR_RECORD_EXTENSION = ".error"
+
+
+def write_error_record(quarantine_root, paths, error):
+    """Record why the files at paths, relative to the quarantine, were not imported."""
+    record = {"files": paths, "error": error, "date": datetime.datetime.now().isoformat()}
+    with open(os.path.join(quarantine_root, paths[-1] + ERROR_RECORD_EXTENSION), "w") as fd:
+        json.dump(record, fd)
+
+
+def get_error_records(quarantine_root):
+    """Yield the path and the content of the error records."""
+    for basename, dirnames, filenames in os.walk(quarantine_root):
+        for filename in sorted(filenames):
+            if filename.endswith(ERROR_RECORD_EXTENSION):
+                record_filepath = os.path.join(basename, filename)
+                with open(record_filepath) as fd:
+                    yield record_filepath, json.load(fd)
+
+
+def requeue(quarantine_root, fs_root, paths=()):
+    """Move quarantined files back to the root directory, return their paths.
+
+    paths are patterns restricting the requeued files, as for the import.
+    """
+    requeued = []
+    for record_filepath, record in list(get_error_records(quarantine_root)):
+        if paths and not utils.pathMatches(record["files"][-1], paths):
+            continue
+        for path in record["files"]:
+            source = os.path.join(quarantine_root, path)
+            if not os.path.exists(source):
+                continue
+            target = os.path.join(fs_root, path)
+            if not os.path.exists(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            os.rename(source, target)
+            requeued.append(path)
+        os.remove(record_filepath)
+        log.info("%s requeued (%s)" % (record["files"][-1], record["error"]))
+    return requeued
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""Internal reference numbers reserved by blocks during bulk imports.
+
+collective.dms.mailcontent bumps a registry counter for each created mail.
+An import reserves a block of numbers at once instead, in a transaction of
+its own, and hands them out locally. Its batch transactions leave the
+counters as they found them, so that they do not conflict with other
+clients numbering mails meanwhile. Numbers of documents that are rolled
+back are handed out again, those left unused at the end are logged.
+Numbers already held by a document are skipped.
+"""
+from plone import api
+from plone.registry.interfaces import IRegistry
+from ZODB.POSException import ConflictError
+from zope.component import getMultiAdapter
+from zope.component import getUtility
+
+import collections
+import logging
+import transaction
+
+
+log = logging.getLogger("collective.dms.batchimport")
+
+COUNTERS = (
+    ("dmsincoming", "collective.dms.mailcontent.browser.settings.IDmsMailConfig.incomingmail"),
+    ("dmsoutgoing", "collective.dms.mailcontent.browser.settings.IDmsMailConfig.outgoingmail"),
+)
+
+# subscribers bumping the counters, useless when the numbers are reserved by blocks
+COUNTER_SUBSCRIBERS = (
+    "collective.dms.mailcontent.dmsmail.incrementIncomingMailNumber",
+    "collective.dms.mailcontent.dmsmail.incrementOutgoingMailNumber",
+)
+
+
+def get_counter(portal_type):
+    """Prefix of the registry records numbering a portal type, if any."""
+    for type_prefix, counter in COUNTERS:
+        if portal_type.startswith(type_prefix):
+            return counter
+    return None
+
+
+class ReferenceAllocator(object):
+    """Internal reference numbers handed out from blocks reserved in the registry."""
+
+    def __init__(self, context, request, block_size=100, retries=5):
+        self.context = context
+        self.request = request
+        self.block_size = block_size
+        self.retries = retries
+        self.registry = getUtility(IRegistry)
+        self.settings_view = None
+        # counter -> [next number, end of the block]
+        self.blocks = {}
+        # counter -> value found by the current transaction
+        self.found = {}
+        # counter -> numbers handed out in the current transaction
+        self.allocated = collections.defaultdict(list)
+        # counter -> numbers handed out then rolled back, handed out again first
+        self.unused = collections.defaultdict(list)
+
+    def allocate(self, portal_type, is_used=None):
+        """Return the next internal reference of portal_type, or None if it is not numbered.
+
+        is_used tells if a reference is already held by a document, its number
+        is then thrown away, not to be handed out again.
+        """
+        counter = get_counter(portal_type)
+        if counter is None:
+            return None
+        number_record = counter + "_number"
+        if number_record not in self.found:
+            self.found[number_record] = self.registry.get(number_record)
+        while True:
+            number = self.next_number(number_record)
+            reference = self.evaluate(counter + "_talexpression", number)
+            if is_used is None or not is_used(reference):
+                break
+            log.warning("internal reference %s of %s is already used, skipped" % (reference, number_record))
+        self.allocated[number_record].append(number)
+        return reference
+
+    def next_number(self, number_record):
+        if self.unused[number_record]:
+            return self.unused[number_record].pop(0)
+        block = self.blocks.get(number_record)
+        if block is None or block[0] >= block[1]:
+            block = self.blocks[number_record] = self.reserve(number_record)
+        number = block[0]
+        block[0] += 1
+        return number
+
+    def evaluate(self, talexpression_record, number):
+        portal = api.portal.get()
+        if self.settings_view is None:
+            self.settings_view = getMultiAdapter((portal, self.request), name=u"dmsmailcontent-settings")
+        expression = self.registry.get(talexpression_record)
+        value = self.settings_view.evaluateTalExpression(expression, self.context, self.request, portal, number)
+        return value.decode("utf8")
+
+    def reserve(self, number_record):
+        first = self.update_counter(number_record, lambda value: (value or 1) + self.block_size) or 1
+        log.info("internal reference numbers %s to %s reserved" % (first, first + self.block_size - 1))
+        return [first, first + self.block_size]
+
+    def update_counter(self, number_record, update):
+        """Update a counter in a transaction of its own, return the value it had.
+
+        update gets the current value and returns the new one, or None to
+        leave it. The transaction is retried on conflicts.
+        """
+        manager = transaction.TransactionManager()
+        connection = self.registry._p_jar.db().open(transaction_manager=manager)
+        try:
+            for attempt in range(self.retries):
+                manager.begin()
+                registry = connection.get(self.registry._p_oid)
+                value = registry.get(number_record)
+                new_value = update(value)
+                if new_value is None:
+                    manager.abort()
+                    return value
+                registry[number_record] = new_value
+                try:
+                    manager.commit()
+                except ConflictError:
+                    manager.abort()
+                    if attempt == self.retries - 1:
+                        raise
+                    log.info("conflict updating %s, retrying" % number_record)
+                else:
+                    return value
+        finally:
+            connection.close()
+
+    def flush(self):
+        """Put back the counters bumped by the mails created in the current transaction."""
+        for number_record, value in self.found.items():
+            if value is not None and self.registry.get(number_record) != value:
+                self.registry[number_record] = value
+        self.found.clear()
+        self.allocated.clear()
+
+    def savepoint(self):
+        """Return the state of the current transaction, to roll back to it."""
+        return dict((number_record, len(numbers)) for number_record, numbers in self.allocated.items())
+
+    def rollback(self, state):
+        """Hand out again the numbers allocated since the state was taken."""
+        for number_record, numbers in self.allocated.items():
+            position = state.get(number_record, 0)
+            self.give_back(number_record, numbers[position:])
+            del numbers[position:]
+
+    def give_back(self, number_record, numbers):
+        if numbers:
+            self.unused[number_record].extend(numbers)
+            self.unused[number_record].sort()
+
+    def clear(self):
+        """Forget the current transaction, which was aborted, its numbers are handed out again."""
+        for number_record, numbers in self.allocated.items():
+            self.give_back(number_record, numbers)
+        self.found.clear()
+        self.allocated.clear()
+
+    def release(self):
+        """Give back the numbers left in the blocks, or log them if another block was reserved since."""
+        blocks, self.blocks = self.blocks, {}
+        unused, self.unused = self.unused, collections.defaultdict(list)
+        for number_record, (first, end) in blocks.items():
+            # unused numbers just before the rest of the block are given back with it
+            numbers = unused[number_record]
+            while numbers and numbers[-1] == first - 1:
+                first = numbers.pop()
+            if first >= end:
+                continue
+            if self.update_counter(number_record, lambda value: first if value == end else None) != end:
+                log.warning(
+                    "internal reference numbers %s to %s of %s are not used" % (first, end - 1, number_record)
+                )
+        for number_record, numbers in unused.items():
+            if numbers:
+                log.warning("internal reference numbers %s of %s are not used" % (numbers, number_record))
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""Routing of files to the documents they are imported as.
+
+A rule matches the name of a file by its code (the part before the first
+``-``), by a prefix or by a regular expression, possibly only in a
+directory and its subdirectories, and gives the portal type of the
+document, the portal type of its file, its owner and default metadata.
+The first matching rule wins; the code to portal type mapping comes after
+the rules.
+
+Rules are compiled into dicts by code and by prefix, so that a file is
+routed with a few lookups, and compiled routers are cached until the
+settings change.
+"""
+import collections
+import fnmatch
+import json
+import re
+
+
+CODE = "code"
+PREFIX = "prefix"
+REGEX = "regex"
+
+Route = collections.namedtuple("Route", "portal_type mainfile_type owner metadata")
+
+
+class RoutingError(Exception):
+    pass
+
+
+def folder_matches(foldername, folder):
+    return not folder or fnmatch.fnmatch(foldername, folder) or foldername.startswith(folder + "/")
+
+
+class Router(object):
+    """Routes of files by their name and directory."""
+
+    def __init__(self, rules=(), code_to_type_mapping=()):
+        # code or prefix -> [(rule index, folder, route)]
+        self.codes = collections.defaultdict(list)
+        self.prefixes = collections.defaultdict(list)
+        # [(rule index, folder, compiled regex, route)]
+        self.regexes = []
+        self.portal_types = set()
+        mapping_rules = [
+            {"match": CODE, "pattern": mapping["code"], "portal_type": mapping["portal_type"]}
+            for mapping in code_to_type_mapping
+        ]
+        for index, rule in enumerate(list(rules) + mapping_rules):
+            self.add(index, rule)
+        self.prefix_lengths = sorted(set(len(prefix) for prefix in self.prefixes))
+
+    def add(self, index, rule):
+        try:
+            metadata = json.loads(rule.get("metadata") or "{}")
+        except ValueError as e:
+            raise RoutingError("rule %s: invalid metadata (%s)" % (index + 1, e))
+        if not isinstance(metadata, dict):
+            raise RoutingError("rule %s: metadata is not an object" % (index + 1))
+        route = Route(rule["portal_type"], rule.get("mainfile_type") or "dmsmainfile", rule.get("owner"), metadata)
+        folder = (rule.get("folder") or u"").strip("/")
+        self.portal_types.add(route.portal_type)
+        match = rule.get("match") or CODE
+        if match == CODE:
+            self.codes[rule["pattern"]].append((index, folder, route))
+        elif match == PREFIX:
+            self.prefixes[rule["pattern"]].append((index, folder, route))
+        elif match == REGEX:
+            try:
+                regex = re.compile(rule["pattern"], re.UNICODE)
+            except re.error as e:
+                raise RoutingError("rule %s: invalid regular expression (%s)" % (index + 1, e))
+            self.regexes.append((index, folder, regex, route))
+        else:
+            raise RoutingError("rule %s: unknown match %s" % (index + 1, match))
+
+    def route(self, foldername, filename):
+        """Return the route of a file and the rest of its name, or None if no rule matches.
+
+        The rest of the name is what follows the code and its ``-`` or the
+        prefix, or the ``name`` group of the regular expression.
+        """
+        best = None
+        code, separator, rest = filename.partition("-")
+        candidates = [(rule, rest) for rule in self.codes.get(code, ())] if separator else []
+        for length in self.prefix_lengths:
+            candidates.extend((rule, filename[length:]) for rule in self.prefixes.get(filename[:length], ()))
+        for (index, folder, route), name in candidates:
+            if (best is None or index < best[0]) and folder_matches(foldername, folder):
+                best = (index, route, name)
+        for index, folder, regex, route in self.regexes:
+            if best is not None and index > best[0]:
+                break
+            match = regex.match(filename)
+            if match is not None and folder_matches(foldername, folder):
+                best = (index, route, match.groupdict().get("name"))
+                break
+        if best is None:
+            return None
+        return (best[1], best[2] or filename)
+
+
+_routers = {}
+
+
+def get_router(rules, code_to_type_mapping):
+    """Return the router of these settings, compiled once until they change."""
+    key = json.dumps([rules or [], code_to_type_mapping or []], sort_keys=True)
+    router = _routers.get(key)
+    if router is None:
+        router = Router(rules or (), code_to_type_mapping or ())
+        _routers.clear()
+        _routers[key] = router
+    return router
@@ -4,6 +4,7 @@ from imio.pyutils.system import error
 from imio.pyutils.system import verbose
 
 import argparse
+import json
 import sys
 
 
@@ -14,3 +15,138 @@ def add_metadata():
     ns = parser.parse_args()
     verbose("Start of %s" % sys.argv[0])
     verbose("End of %s" % sys.argv[0])
+
+
+def print_json(event, data):
+    sys.stdout.write(json.dumps(dict(data, event=event)) + "\n")
+    sys.stdout.flush()
+
+
+def batchimport(app, args):
+    """Run the batch import of a site, outside of any HTTP request.
+
+    Available as `bin/instance batchimport` or `bin/instance run script.py`.
+    Progress and summary are written on stdout as json lines. With --watch,
+    files are imported as they land, with a summary for each micro-batch.
+    With --drain, the deferred event subscribers are run instead.
+    """
+    from AccessControl.SecurityManagement import newSecurityManager
+    from collective.dms.batchimport import deferred
+    from collective.dms.batchimport import hashes
+    from collective.dms.batchimport import quarantine
+    from collective.dms.batchimport.batchimport import BatchImporter
+    from collective.dms.batchimport.batchimport import BatchImportError
+    from collective.dms.batchimport.batchimport import DIRECTORY_ORDER
+    from collective.dms.batchimport.batchimport import OLDEST_ORDER
+    from collective.dms.batchimport.batchimport import ROUND_ROBIN_ORDER
+    from collective.dms.batchimport.watcher import Watcher
+    from Testing.makerequest import makerequest
+    from zope.component.hooks import setSite
+
+    parser = argparse.ArgumentParser(prog="batchimport", description="Import the files of the root directory")
+    parser.add_argument("-s", "--site", default="Plone", help="Path of the site in the Zope application")
+    parser.add_argument("-u", "--user", default="admin", help="User creating the documents")
+    parser.add_argument("--batch-size", type=int, help="Number of documents per transaction")
+    parser.add_argument("--dry-run", action="store_true", help="Check the files without creating anything")
+    parser.add_argument("--limit", type=int, help="Maximum number of files to handle")
+    parser.add_argument(
+        "--path", dest="paths", action="append", default=[], help="Only import files matching this pattern"
+    )
+    parser.add_argument("--max-documents", type=int, help="Stop once this number of documents is imported")
+    parser.add_argument("--max-bytes", type=int, help="Stop once this number of bytes is imported")
+    parser.add_argument("--max-seconds", type=int, help="Stop after this number of seconds")
+    parser.add_argument(
+        "--ordering",
+        choices=[DIRECTORY_ORDER, OLDEST_ORDER, ROUND_ROBIN_ORDER],
+        help="Order in which files are imported",
+    )
+    parser.add_argument("--watch", action="store_true", help="Keep importing files as they land in the root directory")
+    parser.add_argument(
+        "--settle", type=float, default=2.0, help="Seconds a file must stay unchanged before being imported"
+    )
+    parser.add_argument(
+        "--backfill-hashes",
+        action="store_true",
+        help="Add the documents imported before the hash index was enabled to it, instead of importing",
+    )
+    parser.add_argument(
+        "--requeue",
+        action="store_true",
+        help="Move the quarantined files (matching --path) back to the root directory, instead of importing",
+    )
+    parser.add_argument(
+        "--drain", action="store_true", help="Run the event subscribers deferred by the imports, instead of importing"
+    )
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes draining at the same time")
+    parser.add_argument("--worker", type=int, default=0, help="Index of this process among them, from 0")
+    ns = parser.parse_args(args)
+
+    app = makerequest(app)
+    site = app.unrestrictedTraverse(ns.site, None)
+    if site is None:
+        error("site '%s' not found" % ns.site)
+        sys.exit(1)
+    setSite(site)
+    acl_users = site.acl_users
+    user = acl_users.getUser(ns.user)
+    if user is None:
+        acl_users = app.acl_users
+        user = acl_users.getUser(ns.user)
+    if user is None:
+        error("user '%s' not found" % ns.user)
+        sys.exit(1)
+    newSecurityManager(None, user.__of__(acl_users))
+
+    if ns.backfill_hashes:
+        print_json("summary", {"added": hashes.backfill(site, batch_size=ns.batch_size or 100)})
+        return
+    if ns.drain:
+        replayed = deferred.drain(site, worker=ns.worker, workers=ns.workers, batch_size=ns.batch_size or 10)
+        print_json("summary", {"replayed": replayed})
+        return
+
+    importer = BatchImporter(site, app.REQUEST)
+    if not importer.setup(
+        batch_size=ns.batch_size,
+        dry_run=ns.dry_run,
+        limit=ns.limit,
+        paths=[path.decode("utf8") for path in ns.paths],
+        progress=lambda summary: print_json("progress", summary),
+        max_documents=ns.max_documents,
+        max_bytes=ns.max_bytes,
+        max_seconds=ns.max_seconds,
+        ordering=ns.ordering,
+    ):
+        error("the batch import is not configured")
+        sys.exit(1)
+    if ns.requeue:
+        if not importer.quarantine_fs_root_directory:
+            error("no quarantine directory is configured")
+            sys.exit(1)
+        requeued = quarantine.requeue(importer.quarantine_fs_root_directory, importer.fs_root_directory, importer.paths)
+        print_json("summary", {"requeued": len(requeued)})
+        return
+    if not ns.watch:
+        if not importer.lock.acquire():
+            error("an import is already running")
+            sys.exit(1)
+        try:
+            print_json("summary", importer.run())
+        finally:
+            importer.lock.release()
+        return
+    watcher = Watcher(
+        importer.fs_root_directory, settle=ns.settle, max_files=importer.batch_size, heartbeat=importer.lock.refresh
+    )
+    try:
+        for summary in importer.watch(watcher):
+            print_json("summary", summary)
+    except BatchImportError as e:
+        error(str(e))
+        sys.exit(1)
+    except KeyboardInterrupt:
+        verbose("watch stopped")
+
+
+if __name__ == "__main__" and "app" in globals():
+    batchimport(app, sys.argv[1:])  # noqa
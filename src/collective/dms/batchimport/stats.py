@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+from contextlib import contextmanager
+
+import collections
+import math
+import time
+
+
+def percentile(durations, percent):
+    """Nearest-rank percentile of sorted durations."""
+    if not durations:
+        return 0.0
+    rank = int(math.ceil(percent / 100.0 * len(durations))) - 1
+    return durations[min(max(rank, 0), len(durations) - 1)]
+
+
+@contextmanager
+def timer(stats, stage):
+    """Time a stage if stats are collected."""
+    if stats is None:
+        yield
+    else:
+        with stats.timer(stage):
+            yield
+
+
+class ImportStats(object):
+    """Durations of the stages of an import, with its throughput."""
+
+    def __init__(self):
+        self.started = time.time()
+        self.durations = collections.defaultdict(list)
+        self.nb_files = 0
+        self.nb_bytes = 0
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.durations[stage].append(time.time() - start)
+
+    def add_file(self, size):
+        self.nb_files += 1
+        self.nb_bytes += size
+
+    def report(self):
+        elapsed = time.time() - self.started
+        stages = {}
+        for stage, durations in self.durations.items():
+            durations = sorted(durations)
+            total = sum(durations)
+            stages[stage] = {
+                "count": len(durations),
+                "total": total,
+                "mean": total / len(durations),
+                "p50": percentile(durations, 50),
+                "p90": percentile(durations, 90),
+                "p99": percentile(durations, 99),
+                "max": durations[-1],
+            }
+        return {
+            "elapsed": elapsed,
+            "files": self.nb_files,
+            "bytes": self.nb_bytes,
+            "files_per_second": elapsed and self.nb_files / elapsed,
+            "bytes_per_second": elapsed and self.nb_bytes / elapsed,
+            "stages": stages,
+        }
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""Helpers to measure the cost of batch imports on synthetic drop trees."""
+from collective.dms.batchimport import utils
+from collective.dms.batchimport.batchimport import BatchImporter
+from collective.dms.batchimport.batchimport import ISettings
+from plone import api
+from plone.namedfile.file import NamedBlobFile
+from plone.registry.interfaces import IRegistry
+from zope.component import getUtility
+
+import json
+import os
+import random
+import resource
+import time
+import transaction
+
+
+def generate_tree(
+    fs_root,
+    depth=1,
+    dirs=2,
+    files=10,
+    size=1024,
+    metadata_ratio=0.5,
+    duplicate_ratio=0.0,
+    code="in",
+    folder_prefix="folder",
+    seed=0,
+):
+    """Create a drop tree, return the relative paths of its directories.
+
+    Each directory at each level up to depth holds files documents of size
+    bytes, a share of them with a .metadata file and a share of them being
+    duplicates of another document of the directory.
+    """
+    rand = random.Random(seed)
+    data = "%PDF-1.4" + "x" * max(size - 8, 0)
+    foldernames = []
+    level = [""]
+    for _i in range(depth):
+        next_level = []
+        for parent in level:
+            for d in range(dirs):
+                foldername = os.path.join(parent, "%s-%s" % (folder_prefix, d))
+                os.makedirs(os.path.join(fs_root, foldername))
+                foldernames.append(foldername)
+                next_level.append(foldername)
+        level = next_level
+    for foldername in foldernames:
+        for f in range(files):
+            if f and rand.random() < duplicate_ratio:
+                # same id as the previous document once normalized
+                filename = "%s-mail-%s.pdf" % (code, f - 1)
+            else:
+                filename = "%s-mail %s.pdf" % (code, f)
+            filepath = os.path.join(fs_root, foldername, filename)
+            with open(filepath, "w") as fd:
+                fd.write(data)
+            if rand.random() < metadata_ratio:
+                with open(filepath + ".metadata", "w") as fd:
+                    json.dump({"title": u"Mail %s" % f, "description": u"Benchmark"}, fd)
+    return foldernames
+
+
+def create_folders(portal, foldernames):
+    """Create the folders matching a drop tree."""
+    for foldername in foldernames:
+        container = portal
+        for part in foldername.split("/"):
+            if part not in container:
+                api.content.create(container=container, type="Folder", id=part)
+            container = container[part]
+    transaction.commit()
+
+
+def get_max_rss():
+    """Peak resident memory of the process, in kilobytes on Linux."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def benchmark_batchimport(portal, request, fs_root, processed_root, **options):
+    """Import a drop tree with BatchImporter, return its measures."""
+    settings = getUtility(IRegistry).forInterface(ISettings, False)
+    settings.fs_root_directory = fs_root.decode("utf8")
+    settings.processed_fs_root_directory = processed_root.decode("utf8")
+    transaction.commit()
+    max_rss = get_max_rss()
+    start = time.time()
+    importer = BatchImporter(portal, request)
+    importer.setup(**options)
+    summary = importer.run()
+    elapsed = time.time() - start
+    documents = summary["imported"] + summary["errors"]
+    return {
+        "documents": documents,
+        "imported": summary["imported"],
+        "errors": summary["errors"],
+        "elapsed": elapsed,
+        "per_document": documents and elapsed / documents,
+        "max_rss_increase": get_max_rss() - max_rss,
+        "stats": summary["stats"],
+    }
+
+
+def benchmark_create_document(portal, request, folder, nb_documents, size=1024, portal_type="dmsincomingmail"):
+    """Create documents with utils.createDocument, return its measures."""
+    context = BatchImporter(portal, request)
+    index = utils.ImportIndex(portal, [portal_type])
+    data = "%PDF-1.4" + "x" * max(size - 8, 0)
+    max_rss = get_max_rss()
+    start = time.time()
+    for i in range(nb_documents):
+        document_file = NamedBlobFile(data, filename=u"mail-%s.pdf" % i)
+        utils.createDocument(context, folder, portal_type, "benchmark-%s" % i, document_file, index=index)
+    transaction.commit()
+    elapsed = time.time() - start
+    return {
+        "documents": nb_documents,
+        "elapsed": elapsed,
+        "per_document": elapsed / nb_documents,
+        "max_rss_increase": get_max_rss() - max_rss,
+    }
@@ -0,0 +1,77 @@
+from collective.dms.batchimport.archives import Archive
+from collective.dms.batchimport.archives import ArchiveError
+from collective.dms.batchimport.archives import split_path
+
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest2 as unittest
+import zipfile
+
+
+class TestArchive(unittest.TestCase):
+    def setUp(self):
+        self.fs_root = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.fs_root, "drop.zip")
+        with zipfile.ZipFile(self.filepath, "w") as archive:
+            archive.writestr("in-mail.pdf", "scanned mail")
+            archive.writestr("in-mail.pdf.metadata", '{"title": "Mail"}')
+            archive.writestr("sub/in-other.pdf", "other scanned mail")
+            archive.writestr(".hidden", "")
+
+    def tearDown(self):
+        shutil.rmtree(self.fs_root)
+
+    def test_entries(self):
+        archive = Archive(self.filepath)
+        self.assertEqual(
+            archive.get_entries(), [(u"in-mail.pdf", u"in-mail.pdf.metadata"), (u"sub/in-other.pdf", None)]
+        )
+        self.assertEqual(archive.read(u"in-mail.pdf.metadata"), '{"title": "Mail"}')
+
+    def test_paths(self):
+        archive = Archive(self.filepath)
+        path = archive.get_path(u"sub/in-other.pdf")
+        self.assertEqual(archive.get_name(path), u"sub/in-other.pdf")
+        self.assertEqual(split_path(path), (self.filepath, u"sub/in-other.pdf"))
+        self.assertEqual(split_path(self.filepath), (self.filepath, None))
+
+    def test_progress(self):
+        archive = Archive(self.filepath)
+        archive.mark_as_done(u"in-mail.pdf")
+        archive.mark_as_done(u"in-mail.pdf.metadata")
+        self.assertFalse(archive.is_complete())
+        archive = Archive(self.filepath)
+        self.assertEqual(archive.get_remaining_entries(), [(u"sub/in-other.pdf", None)])
+        archive.mark_as_done(u"sub/in-other.pdf")
+        self.assertTrue(archive.is_complete())
+
+    def test_tar(self):
+        filepath = os.path.join(self.fs_root, "drop.tar.gz")
+        with tarfile.open(filepath, "w:gz") as archive:
+            archive.add(self.filepath, "in-mail.pdf")
+        archive = Archive(filepath)
+        self.assertEqual(archive.get_entries(), [(u"in-mail.pdf", None)])
+        with open(self.filepath, "rb") as fd:
+            self.assertEqual(archive.read(u"in-mail.pdf"), fd.read())
+
+    def test_tar_metadata(self):
+        filepath = os.path.join(self.fs_root, "drop.tar.gz")
+        metadata_filepath = os.path.join(self.fs_root, "in-mail.pdf.metadata")
+        with open(metadata_filepath, "w") as fd:
+            fd.write('{"title": "Mail"}')
+        with tarfile.open(filepath, "w:gz") as archive:
+            archive.add(self.filepath, "in-mail.pdf")
+            archive.add(metadata_filepath, "in-mail.pdf.metadata")
+        archive = Archive(filepath)
+        self.assertEqual(archive.get_entries(), [(u"in-mail.pdf", u"in-mail.pdf.metadata")])
+        # read when the archive was opened, without going back in the compressed stream
+        archive.archive.extractfile = None
+        self.assertEqual(archive.read(u"in-mail.pdf.metadata"), '{"title": "Mail"}')
+
+    def test_broken_archive(self):
+        filepath = os.path.join(self.fs_root, "broken.tar")
+        with open(filepath, "w") as fd:
+            fd.write("not an archive")
+        self.assertRaises(ArchiveError, Archive, filepath)
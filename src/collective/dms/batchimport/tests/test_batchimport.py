@@ -0,0 +1,644 @@
+from collective.dms.batchimport import deferred
+from collective.dms.batchimport import hashes
+from collective.dms.batchimport import indexing
+from collective.dms.batchimport import jobs
+from collective.dms.batchimport import quarantine
+from collective.dms.batchimport.batchimport import BatchImporter
+from collective.dms.batchimport.batchimport import ISettings
+from collective.dms.batchimport.batchimport import JOURNAL_FILENAME
+from collective.dms.batchimport.claims import ImportLock
+from collective.dms.batchimport.testing import FUNCTIONAL
+from collective.dms.mailcontent.dmsmail import IDmsIncomingMail
+from plone import api
+from plone.app.testing import setRoles
+from plone.app.testing import TEST_USER_ID
+from plone.registry.interfaces import IRegistry
+from ZODB.POSException import ConflictError
+from zope.component import getGlobalSiteManager
+from zope.component import getUtility
+from zope.lifecycleevent.interfaces import IObjectAddedEvent
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import transaction
+import unittest2 as unittest
+import zipfile
+
+
+added_mails = []
+
+
+def record_added_mail(mail, event):
+    added_mails.append((mail.getId(), event.newName))
+
+
+class TestBatchImporter(unittest.TestCase):
+
+    layer = FUNCTIONAL
+
+    def setUp(self):
+        self.portal = self.layer["portal"]
+        self.request = self.layer["request"]
+        setRoles(self.portal, TEST_USER_ID, ["Manager"])
+        self.folder = api.content.create(container=self.portal, type="Folder", id="incoming-mails")
+        self.fs_root = tempfile.mkdtemp()
+        self.processed_root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.fs_root, "incoming-mails"))
+        self.settings = getUtility(IRegistry).forInterface(ISettings, False)
+        self.settings.fs_root_directory = self.fs_root.decode("utf8")
+        self.settings.processed_fs_root_directory = self.processed_root.decode("utf8")
+        self.settings.code_to_type_mapping = [{"code": u"in", "portal_type": u"dmsincomingmail"}]
+
+    def tearDown(self):
+        shutil.rmtree(self.fs_root)
+        shutil.rmtree(self.processed_root)
+
+    def add_file(self, filename, metadata=None, foldername="incoming-mails"):
+        filepath = os.path.join(self.fs_root, foldername, filename)
+        with open(filepath, "w") as fd:
+            fd.write("%PDF-1.4 scanned mail")
+        if metadata is not None:
+            with open(filepath + ".metadata", "w") as fd:
+                json.dump(metadata, fd)
+        return filepath
+
+    def run_import(self):
+        return BatchImporter(self.portal, self.request)()
+
+    def run_importer(self, **options):
+        importer = BatchImporter(self.portal, self.request)
+        self.assertTrue(importer.setup(**options))
+        return importer.run()
+
+    def test_import(self):
+        self.add_file("in-mail 1.pdf")
+        self.add_file("in-mail 2.pdf", metadata={"title": u"Second mail"})
+        self.assertEqual(self.run_import(), "OK (2 imported files, 0 unprocessed files)")
+        self.assertIn("mail-1", self.folder)
+        self.assertEqual(self.folder["mail-2"].title, u"Second mail")
+        self.assertEqual(os.listdir(os.path.join(self.fs_root, "incoming-mails")), [])
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(self.processed_root, "incoming-mails"))),
+            ["in-mail 1.pdf", "in-mail 2.pdf", "in-mail 2.pdf.metadata"],
+        )
+
+    def test_json_report(self):
+        self.add_file("in-mail.pdf")
+        self.request.form["report"] = "json"
+        report = json.loads(self.run_import())
+        self.assertEqual(report["imported"], 1)
+        self.assertEqual(report["stats"]["files"], 1)
+        self.assertEqual(report["stats"]["bytes"], len("%PDF-1.4 scanned mail"))
+        self.assertEqual(report["stats"]["stages"]["create"]["count"], 1)
+
+    def test_background_job(self):
+        self.add_file("in-mail.pdf")
+        transaction.commit()
+        self.request.form["background"] = "1"
+        job = jobs.get_job(json.loads(self.run_import())["job"])
+        job.join()
+        self.request.form = {"job": job.id}
+        status = json.loads(self.portal.restrictedTraverse("@@batchimport-status")())
+        self.assertEqual((status["state"], status["imported"], status["total"]), (jobs.FINISHED, 1, 1))
+        self.assertEqual(status["directory"], u"incoming-mails")
+        self.assertIsNone(job.importer)
+        # saved for the other ZEO clients
+        del jobs._jobs[job.id]
+        saved_status = json.loads(self.portal.restrictedTraverse("@@batchimport-status")())
+        self.assertEqual((saved_status["state"], saved_status["imported"]), (jobs.FINISHED, 1))
+        transaction.begin()
+        self.assertIn("mail", self.folder)
+
+    def test_import_already_running(self):
+        self.add_file("in-mail.pdf")
+        # e.g. held by another ZEO client
+        lock = ImportLock(self.fs_root)
+        lock.acquire()
+        try:
+            self.assertEqual(self.run_import(), "ERROR (an import is already running)")
+            self.request.form["background"] = "1"
+            self.assertEqual(json.loads(self.run_import())["error"], "an import is already running")
+            self.assertEqual(self.request.response.getStatus(), 409)
+        finally:
+            lock.release()
+        self.assertEqual(os.listdir(os.path.join(self.fs_root, "incoming-mails")), ["in-mail.pdf"])
+
+    def test_concurrent_imports_with_claims(self):
+        self.settings.claim_directories = True
+        api.content.create(container=self.portal, type="Folder", id="other-mails")
+        os.mkdir(os.path.join(self.fs_root, "other-mails"))
+        self.add_file("in-mail.pdf")
+        self.add_file("in-other.pdf", foldername="other-mails")
+        # an import running on another ZEO client, importing incoming-mails
+        other_importer = BatchImporter(self.portal, self.request)
+        self.assertTrue(other_importer.setup())
+        self.assertTrue(other_importer.lock.acquire())
+        self.assertTrue(other_importer.claims.claim(u"incoming-mails"))
+        try:
+            self.assertEqual(self.run_import(), "OK (1 imported files, 0 unprocessed files)")
+            self.assertEqual(self.portal["other-mails"].objectIds(), ["other"])
+            self.assertEqual(self.folder.objectIds(), [])
+        finally:
+            other_importer.claims.release_all()
+            other_importer.lock.release()
+        self.assertEqual(self.run_import(), "OK (1 imported files, 0 unprocessed files)")
+        self.assertEqual(self.folder.objectIds(), ["mail"])
+
+    def test_import_blob(self):
+        self.add_file("in-mail.pdf")
+        self.run_import()
+        blob_file = self.folder["mail"].objectValues()[0].file
+        self.assertEqual(blob_file.filename, u"mail.pdf")
+        self.assertEqual(blob_file.data, "%PDF-1.4 scanned mail")
+
+    def test_import_hardlinked_blob(self):
+        self.settings.hardlink_blobs = True
+        self.add_file("in-mail.pdf")
+        self.run_import()
+        self.assertEqual(self.folder["mail"].objectValues()[0].file.data, "%PDF-1.4 scanned mail")
+        self.assertEqual(os.listdir(os.path.join(self.processed_root, "incoming-mails")), ["in-mail.pdf"])
+        self.assertEqual(os.listdir(os.path.join(self.fs_root, "incoming-mails")), [])
+
+    def test_import_by_batches(self):
+        self.settings.batch_size = 2
+        for i in range(5):
+            self.add_file("in-mail %s.pdf" % i)
+        self.assertEqual(self.run_import(), "OK (5 imported files, 0 unprocessed files)")
+        self.assertEqual(len(self.folder.objectIds()), 5)
+        self.assertFalse(os.path.exists(os.path.join(self.fs_root, JOURNAL_FILENAME)))
+
+    def test_prefetch(self):
+        self.settings.prefetch_workers = 2
+        for i in range(10):
+            self.add_file("in-mail %s.pdf" % i, metadata={"title": u"Mail %s" % i})
+        self.assertEqual(self.run_import(), "OK (10 imported files, 0 unprocessed files)")
+        self.assertEqual(self.folder["mail-9"].title, u"Mail 9")
+
+    def test_defer_indexing(self):
+        self.settings.defer_indexing = True
+        self.settings.batch_size = 2
+        for i in range(3):
+            self.add_file("in-mail %s.pdf" % i, metadata={"title": u"Mail %s" % i})
+        self.assertEqual(self.run_import(), "OK (3 imported files, 0 unprocessed files)")
+        self.assertIsNone(indexing.get_queue())
+        brains = api.content.find(context=self.folder, portal_type="dmsincomingmail", sort_on="id")
+        self.assertEqual([brain.Title for brain in brains], ["Mail 0", "Mail 1", "Mail 2"])
+
+    def test_reserve_reference_numbers(self):
+        registry = getUtility(IRegistry)
+        number_record = "collective.dms.mailcontent.browser.settings.IDmsMailConfig.incomingmail_number"
+        registry[number_record] = 10
+        registry["collective.dms.mailcontent.browser.settings.IDmsMailConfig.incomingmail_talexpression"] = (
+            u"python:'in/'+number"
+        )
+        self.settings.reserve_reference_numbers = True
+        self.settings.batch_size = 2
+        transaction.commit()
+        for i in range(3):
+            self.add_file("in-mail %s.pdf" % i)
+        self.assertEqual(self.run_import(), "OK (3 imported files, 0 unprocessed files)")
+        self.assertEqual(
+            sorted(document.internal_reference_no for document in self.folder.objectValues()),
+            [u"in/10", u"in/11", u"in/12"],
+        )
+        # the unused number of the last block is given back
+        self.assertEqual(registry[number_record], 13)
+
+    def test_rolled_back_reference_numbers(self):
+        registry = getUtility(IRegistry)
+        number_record = "collective.dms.mailcontent.browser.settings.IDmsMailConfig.incomingmail_number"
+        registry[number_record] = 10
+        registry["collective.dms.mailcontent.browser.settings.IDmsMailConfig.incomingmail_talexpression"] = (
+            u"python:'in/'+number"
+        )
+        self.settings.reserve_reference_numbers = True
+        transaction.commit()
+        for i in range(3):
+            self.add_file("in-mail %s.pdf" % i)
+        importer = BatchImporter(self.portal, self.request)
+        self.assertTrue(importer.setup(batch_size=2))
+        import_one = importer.import_one
+
+        def failing_import_one(filepath, *args, **kwargs):
+            document = import_one(filepath, *args, **kwargs)
+            if filepath.endswith("1.pdf"):
+                raise ValueError("broken after its creation")
+            return document
+
+        importer.import_one = failing_import_one
+        summary = importer.run()
+        self.assertEqual((summary["imported"], summary["errors"]), (2, 1))
+        # the number of the rolled back document is handed out to the next one
+        self.assertEqual(
+            sorted(document.internal_reference_no for document in self.folder.objectValues()), [u"in/10", u"in/11"]
+        )
+        self.assertEqual(registry[number_record], 12)
+
+    def test_used_reference_numbers(self):
+        api.content.create(
+            container=self.folder, type="dmsincomingmail", id="existing", internal_reference_no=u"in/10"
+        )
+        registry = getUtility(IRegistry)
+        number_record = "collective.dms.mailcontent.browser.settings.IDmsMailConfig.incomingmail_number"
+        registry[number_record] = 10
+        registry["collective.dms.mailcontent.browser.settings.IDmsMailConfig.incomingmail_talexpression"] = (
+            u"python:'in/'+number"
+        )
+        self.settings.reserve_reference_numbers = True
+        transaction.commit()
+        for i in range(2):
+            self.add_file("in-mail %s.pdf" % i)
+        # the number already held is skipped, not handed out again to each document
+        self.assertEqual(self.run_import(), "OK (2 imported files, 0 unprocessed files)")
+        self.assertEqual(
+            sorted(document.internal_reference_no for document in self.folder.objectValues()),
+            [u"in/10", u"in/11", u"in/12"],
+        )
+        self.assertEqual(registry[number_record], 13)
+
+    def test_deferred_subscribers(self):
+        site_manager = getGlobalSiteManager()
+        site_manager.registerHandler(record_added_mail, (IDmsIncomingMail, IObjectAddedEvent))
+        self.addCleanup(site_manager.unregisterHandler, record_added_mail, (IDmsIncomingMail, IObjectAddedEvent))
+        self.addCleanup(added_mails.__delitem__, slice(None))
+        self.settings.deferred_subscribers = [u"collective.dms.batchimport.tests.test_batchimport.record_added_mail"]
+        self.add_file("in-mail.pdf")
+        summary = self.run_importer()
+        self.assertEqual((summary["imported"], summary["deferred"]), (1, 1))
+        self.assertEqual(added_mails, [])
+        self.assertEqual(deferred.drain(self.portal), 1)
+        mail_id = self.folder.objectIds()[0]
+        self.assertEqual(added_mails, [(mail_id, mail_id)])
+        self.assertEqual(deferred.drain(self.portal), 0)
+
+    def test_dry_run(self):
+        filepath = self.add_file("in-mail.pdf")
+        self.add_file("in-mail-.pdf")
+        self.add_file("out-mail.pdf")
+        summary = self.run_importer(dry_run=True)
+        self.assertEqual((summary["imported"], summary["errors"]), (1, 2))
+        self.assertEqual(self.folder.objectIds(), [])
+        self.assertTrue(os.path.exists(filepath))
+
+    def test_limit_and_paths(self):
+        os.mkdir(os.path.join(self.fs_root, "incoming-mails", "other"))
+        for i in range(5):
+            self.add_file("in-mail %s.pdf" % i)
+        self.add_file("in-other.pdf", foldername="incoming-mails/other")
+        progress = []
+        summary = self.run_importer(limit=3, paths=[u"incoming-mails/in-*"], batch_size=2, progress=progress.append)
+        self.assertEqual(summary["imported"], 3)
+        self.assertEqual(len(progress), 2)
+        self.assertEqual(len(self.folder.objectIds()), 3)
+
+    def test_import_files(self):
+        self.add_file("in-mail 1.pdf", metadata={"title": u"First mail"})
+        self.add_file("in-mail 2.pdf")
+        importer = BatchImporter(self.portal, self.request)
+        self.assertTrue(importer.setup())
+        summary = importer.run([u"incoming-mails/in-mail 1.pdf.metadata", u"incoming-mails/in-mail 1.pdf"])
+        self.assertEqual(summary["imported"], 1)
+        self.assertEqual(self.folder.objectIds(), ["mail-1"])
+        self.assertEqual(os.listdir(os.path.join(self.fs_root, "incoming-mails")), ["in-mail 2.pdf"])
+
+    def test_import_archive(self):
+        filepath = os.path.join(self.fs_root, "incoming-mails", "drop.zip")
+        with zipfile.ZipFile(filepath, "w") as archive:
+            archive.writestr("in-mail 1.pdf", "%PDF-1.4 scanned mail")
+            archive.writestr("in-mail 1.pdf.metadata", json.dumps({"title": u"First mail"}))
+            archive.writestr("in-mail 2.pdf", "%PDF-1.4 scanned mail")
+            archive.writestr("out-mail.pdf", "%PDF-1.4 scanned mail")
+        self.assertEqual(self.run_import(), "OK (2 imported files, 1 unprocessed files)")
+        self.assertEqual(self.folder["mail-1"].title, u"First mail")
+        self.assertEqual(self.folder["mail-2"].objectValues()[0].file.data, "%PDF-1.4 scanned mail")
+        # kept until all its files are imported
+        self.assertTrue(os.path.exists(filepath))
+        self.settings.code_to_type_mapping = [
+            {"code": u"in", "portal_type": u"dmsincomingmail"},
+            {"code": u"out", "portal_type": u"dmsincomingmail"},
+        ]
+        self.assertEqual(self.run_import(), "OK (1 imported files, 0 unprocessed files)")
+        self.assertEqual(os.listdir(os.path.join(self.fs_root, "incoming-mails")), [])
+        self.assertEqual(os.listdir(os.path.join(self.processed_root, "incoming-mails")), ["drop.zip"])
+
+    def test_directory_metadata(self):
+        self.add_file("in-mail 1.pdf")
+        self.add_file("in-mail 2.pdf", metadata={"title": u"Own metadata"})
+        self.add_file("in-mail 3.pdf")
+        with open(os.path.join(self.fs_root, "incoming-mails", "metadata.jsonl"), "w") as fd:
+            fd.write(json.dumps({"filename": "in-mail 1.pdf", "title": u"First mail"}) + "\n")
+            fd.write(json.dumps({"filename": "in-mail 2.pdf", "title": u"Ignored"}) + "\n")
+        self.assertEqual(self.run_import(), "OK (3 imported files, 0 unprocessed files)")
+        self.assertEqual(self.folder["mail-1"].title, u"First mail")
+        self.assertEqual(self.folder["mail-2"].title, u"Own metadata")
+        self.assertEqual(self.folder["mail-3"].title, u"mail 3")
+        # processed once there is nothing else to import in its directory
+        self.assertEqual(os.listdir(os.path.join(self.fs_root, "incoming-mails")), ["metadata.jsonl"])
+        self.run_import()
+        self.assertEqual(os.listdir(os.path.join(self.fs_root, "incoming-mails")), [])
+
+    def test_owners(self):
+        api.user.create(email="scanner@example.com", username="scanner", password="secret", roles=("Manager",))
+        for i in range(4):
+            self.add_file("in-mail %s.pdf" % i)
+        with open(os.path.join(self.fs_root, "incoming-mails", "metadata.jsonl"), "w") as fd:
+            for i, owner in enumerate([u"scanner", None, u"scanner", u"unknown"]):
+                fd.write(json.dumps({"filename": "in-mail %s.pdf" % i, "owner": owner}) + "\n")
+        importer = BatchImporter(self.portal, self.request)
+        self.assertTrue(importer.setup())
+        summary = importer.run()
+        self.assertEqual((summary["imported"], summary["errors"]), (3, 1))
+        owners = [document.getOwner().getId() for document in self.folder.objectValues()]
+        # grouped by owner, each one looked up once
+        self.assertEqual(owners, [TEST_USER_ID, "scanner", "scanner"])
+        self.assertEqual(sorted(importer.owners.users), ["scanner", "unknown"])
+        self.assertEqual(api.user.get_current().getId(), TEST_USER_ID)
+
+    def test_duplicate_content(self):
+        self.settings.duplicate_content_policy = "skip"
+        self.add_file("in-mail.pdf")
+        self.assertEqual(self.run_import(), "OK (1 imported files, 0 unprocessed files)")
+        self.add_file("in-copy.pdf")
+        self.assertEqual(self.run_import(), "OK (0 imported files, 1 unprocessed files)")
+        self.settings.duplicate_content_policy = "link"
+        self.assertEqual(self.run_import(), "OK (1 imported files, 0 unprocessed files)")
+        copy_file = self.folder["copy"].objectValues()[0].file
+        mail_file = self.folder["mail"].objectValues()[0].file
+        self.assertEqual(copy_file.data, "%PDF-1.4 scanned mail")
+        # same content on disk, in blobs of their own
+        self.assertNotEqual(copy_file._blob._p_oid, mail_file._blob._p_oid)
+        copy_file.data = "rescanned mail"
+        transaction.commit()
+        self.assertEqual(mail_file.data, "%PDF-1.4 scanned mail")
+
+    def test_backfill_hashes(self):
+        self.add_file("in-mail.pdf")
+        self.run_import()
+        index = hashes.HashIndex(self.portal)
+        self.assertEqual(len(index), 0)
+        self.assertEqual(hashes.backfill(self.portal), 1)
+        digest = hashlib.sha256("%PDF-1.4 scanned mail").hexdigest()
+        self.assertEqual(index.get_document(digest), self.folder["mail"])
+        self.assertEqual(hashes.backfill(self.portal), 0)
+
+    def test_budgets(self):
+        for i in range(5):
+            self.add_file("in-mail %s.pdf" % i)
+        summary = self.run_importer(max_documents=2)
+        self.assertEqual((summary["imported"], summary["stopped"], summary["remaining"]), (2, "max_documents", 3))
+        summary = self.run_importer(max_bytes=1)
+        self.assertEqual((summary["imported"], summary["stopped"], summary["remaining"]), (1, "max_bytes", 2))
+        summary = self.run_importer(max_seconds=3600)
+        self.assertEqual(summary["imported"], 2)
+        self.assertNotIn("stopped", summary)
+
+    def test_high_water(self):
+        self.settings.max_cache_objects = 1
+        for i in range(3):
+            self.add_file("in-mail %s.pdf" % i)
+        progress = []
+        summary = self.run_importer(batch_size=10, progress=progress.append)
+        self.assertEqual(summary["imported"], 3)
+        # each document is committed in a batch of its own, before the final commit
+        self.assertEqual([batch["imported"] for batch in progress], [1, 2, 3, 3])
+
+    def test_high_water_latched(self):
+        self.settings.max_memory = 1
+        for i in range(3):
+            self.add_file("in-mail %s.pdf" % i)
+        progress = []
+        summary = self.run_importer(batch_size=10, progress=progress.append)
+        self.assertEqual(summary["imported"], 3)
+        # emptying the cache does not bring the memory below 1 MB, only the first batch is committed early
+        self.assertEqual([batch["imported"] for batch in progress], [1, 3])
+
+    def test_ordering(self):
+        api.content.create(container=self.portal, type="Folder", id="other-mails")
+        os.mkdir(os.path.join(self.fs_root, "other-mails"))
+        for i in range(3):
+            self.add_file("in-mail %s.pdf" % i)
+        self.add_file("in-other.pdf", foldername="other-mails")
+        os.utime(os.path.join(self.fs_root, "incoming-mails", "in-mail 2.pdf"), (0, 0))
+        self.run_importer(ordering="oldest", max_documents=1)
+        self.assertEqual(self.folder.objectIds(), ["mail-2"])
+        self.run_importer(ordering="round_robin", max_documents=2)
+        self.assertEqual(self.folder.objectIds(), ["mail-2", "mail-0"])
+        self.assertEqual(self.portal["other-mails"].objectIds(), ["other"])
+
+    def test_oldest_first_claims(self):
+        self.settings.claim_directories = True
+        api.content.create(container=self.portal, type="Folder", id="other-mails")
+        os.mkdir(os.path.join(self.fs_root, "other-mails"))
+        self.add_file("in-mail.pdf")
+        self.add_file("in-other.pdf", foldername="other-mails")
+        os.utime(os.path.join(self.fs_root, "other-mails", "in-other.pdf"), (0, 0))
+        importer = BatchImporter(self.portal, self.request)
+        self.assertTrue(importer.setup(ordering="oldest"))
+        entries = importer.walk_oldest_first()
+        self.assertEqual(os.path.basename(next(entries).filepath), u"in-other.pdf")
+        # the other directory is left to concurrent imports until its turn comes
+        self.assertEqual(list(importer.claims.claimed), [u"other-mails"])
+        self.assertEqual(os.path.basename(next(entries).filepath), u"in-mail.pdf")
+        self.assertEqual(sorted(importer.claims.claimed), [u"incoming-mails", u"other-mails"])
+        importer.claims.release_all()
+
+    def test_remaining_files_with_manifest(self):
+        self.settings.scan_manifest = True
+        self.settings.processed_fs_root_directory = self.settings.fs_root_directory
+        self.add_file("in-mail 0.pdf")
+        self.run_import()
+        for i in range(1, 4):
+            self.add_file("in-mail %s.pdf" % i)
+        summary = self.run_importer(max_documents=1)
+        # the file imported by the first import is not remaining
+        self.assertEqual((summary["imported"], summary["remaining"]), (1, 2))
+
+    def test_conflicts_and_unexpected_errors(self):
+        for i in range(3):
+            self.add_file("in-mail %s.pdf" % i)
+        importer = BatchImporter(self.portal, self.request)
+        self.assertTrue(importer.setup())
+        import_one = importer.import_one
+        calls = []
+
+        def unreliable_import_one(filepath, *args, **kwargs):
+            calls.append(filepath)
+            if len(calls) == 1:
+                raise ConflictError()
+            if filepath.endswith("1.pdf"):
+                raise ValueError("unreadable file")
+            return import_one(filepath, *args, **kwargs)
+
+        importer.import_one = unreliable_import_one
+        summary = importer.run()
+        # the conflicting file is retried, the broken one is left without stopping the import
+        self.assertEqual((summary["imported"], summary["errors"]), (2, 1))
+        self.assertEqual(summary["stats"]["stages"]["conflict"]["count"], 1)
+        self.assertEqual(len(self.folder.objectIds()), 2)
+
+    def test_commit_conflicts(self):
+        self.settings.batch_size = 1
+        self.settings.conflict_retries = 2
+        for i in range(2):
+            self.add_file("in-mail %s.pdf" % i)
+        commits = []
+
+        def conflicting_commit():
+            commits.append(True)
+            raise ConflictError()
+
+        self.addCleanup(setattr, transaction, "commit", transaction.commit)
+        transaction.commit = conflicting_commit
+        summary = self.run_importer()
+        transaction.abort()
+        # each batch is committed once, then retried twice, document by document
+        self.assertEqual(len(commits), 6)
+        self.assertEqual((summary["imported"], summary["errors"]), (0, 2))
+
+    def test_conflict_after_creation(self):
+        self.settings.duplicate_content_policy = "import"
+        self.add_file("in-mail.pdf")
+        importer = BatchImporter(self.portal, self.request)
+        self.assertTrue(importer.setup())
+        set_hash = importer.hashes.set
+        calls = []
+
+        def conflicting_set_hash(digest, document):
+            calls.append(digest)
+            if len(calls) == 1:
+                raise ConflictError()
+            set_hash(digest, document)
+
+        importer.hashes.set = conflicting_set_hash
+        summary = importer.run()
+        # the document created before the conflict does not make its retry a duplicate
+        self.assertEqual((summary["imported"], summary["errors"]), (1, 0))
+        self.assertEqual(self.folder.objectIds(), ["mail"])
+
+    def test_routing_rules(self):
+        self.settings.routing_rules = [
+            {
+                "match": u"prefix",
+                "pattern": u"SCAN_",
+                "folder": u"incoming-mails",
+                "portal_type": u"dmsincomingmail",
+                "metadata": u'{"description": "Scanned"}',
+            }
+        ]
+        self.add_file("SCAN_0001.pdf")
+        self.add_file("in-mail.pdf")
+        self.assertEqual(self.run_import(), "OK (2 imported files, 0 unprocessed files)")
+        self.assertEqual(sorted(document.description for document in self.folder.objectValues()), [u"", u"Scanned"])
+
+    def test_unknown_code(self):
+        filepath = self.add_file("out-mail.pdf")
+        self.assertEqual(self.run_import(), "OK (0 imported files, 1 unprocessed files)")
+        self.assertTrue(os.path.exists(filepath))
+
+    def test_quarantine(self):
+        quarantine_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, quarantine_root)
+        self.settings.quarantine_fs_root_directory = quarantine_root.decode("utf8")
+        self.add_file("out-mail.pdf", metadata={"title": u"Outgoing mail"})
+        self.add_file("in-mail.pdf")
+        self.assertEqual(self.run_import(), "OK (1 imported files, 1 unprocessed files)")
+        self.assertEqual(os.listdir(os.path.join(self.fs_root, "incoming-mails")), [])
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(quarantine_root, "incoming-mails"))),
+            ["out-mail.pdf", "out-mail.pdf.error", "out-mail.pdf.metadata"],
+        )
+        with open(os.path.join(quarantine_root, "incoming-mails", "out-mail.pdf.error")) as fd:
+            record = json.load(fd)
+        self.assertEqual(record["files"], ["incoming-mails/out-mail.pdf.metadata", "incoming-mails/out-mail.pdf"])
+        self.assertEqual(record["error"], "no portal type associated to this code 'out'")
+        # not retried by next imports
+        self.assertEqual(self.run_import(), "OK (0 imported files, 0 unprocessed files)")
+        self.assertEqual(
+            quarantine.requeue(quarantine_root, self.fs_root, [u"incoming-mails/out-*"]),
+            ["incoming-mails/out-mail.pdf.metadata", "incoming-mails/out-mail.pdf"],
+        )
+        self.assertEqual(os.listdir(os.path.join(quarantine_root, "incoming-mails")), [])
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(self.fs_root, "incoming-mails"))), ["out-mail.pdf", "out-mail.pdf.metadata"]
+        )
+
+    def test_invalid_metadata(self):
+        quarantine_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, quarantine_root)
+        self.settings.quarantine_fs_root_directory = quarantine_root.decode("utf8")
+        filepath = self.add_file("in-mail 1.pdf")
+        with open(filepath + ".metadata", "w") as fd:
+            fd.write('{"title": ')
+        self.add_file("in-mail 2.pdf")
+        # the other files are still imported
+        self.assertEqual(self.run_import(), "OK (1 imported files, 1 unprocessed files)")
+        self.assertEqual(self.folder.objectIds(), ["mail-2"])
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(quarantine_root, "incoming-mails"))),
+            ["in-mail 1.pdf", "in-mail 1.pdf.error", "in-mail 1.pdf.metadata"],
+        )
+
+    def test_directory_structure_mismatch(self):
+        os.mkdir(os.path.join(self.fs_root, "incoming-mails", "incoming-mails"))
+        self.add_file("in-mail 1.pdf", foldername="incoming-mails/incoming-mails")
+        self.add_file("in-mail 2.pdf", metadata={}, foldername="incoming-mails/incoming-mails")
+        # the parent folder must not be acquired
+        self.assertEqual(self.run_import(), "OK (0 imported files, 2 unprocessed files)")
+        self.assertEqual(self.folder.objectIds(), [])
+
+    def test_existing_document(self):
+        api.content.create(container=self.folder, type="dmsincomingmail", id="mail", title=u"Mail")
+        self.add_file("in-mail.pdf")
+        self.add_file("in-mail twice.pdf")
+        self.add_file("in-mail-twice.pdf")
+        self.assertEqual(self.run_import(), "OK (1 imported files, 2 unprocessed files)")
+        self.assertIn("mail-twice", self.folder)
+
+    def test_errors_keep_import_index(self):
+        api.content.create(
+            container=self.folder, type="dmsincomingmail", id="existing", internal_reference_no=u"in/10"
+        )
+        for i in range(3):
+            self.add_file("in-mail %s.pdf" % i, metadata={"internal_reference_no": u"in/10"})
+        self.add_file("in-mail 3.pdf")
+        importer = BatchImporter(self.portal, self.request)
+        self.assertTrue(importer.setup())
+        load_reference_numbers = importer.index.load_reference_numbers
+        loads = []
+
+        def counted_load_reference_numbers():
+            loads.append(True)
+            load_reference_numbers()
+
+        importer.index.load_reference_numbers = counted_load_reference_numbers
+        summary = importer.run()
+        self.assertEqual((summary["imported"], summary["errors"]), (1, 3))
+        # the documents rolled back leave the rest of the index in place
+        self.assertEqual(len(loads), 1)
+
+    def test_scan_manifest(self):
+        self.settings.scan_manifest = True
+        self.settings.processed_fs_root_directory = self.settings.fs_root_directory
+        self.add_file("in-mail.pdf")
+        self.add_file("out-mail.pdf")
+        self.assertEqual(self.run_import(), "OK (1 imported files, 1 unprocessed files)")
+        # nothing changed since the previous import
+        self.assertEqual(self.run_import(), "OK (0 imported files, 0 unprocessed files)")
+        with open(os.path.join(self.fs_root, "incoming-mails", "out-mail.pdf"), "a") as fd:
+            fd.write("rescanned")
+        self.assertEqual(self.run_import(), "OK (0 imported files, 1 unprocessed files)")
+
+    def test_recover_journal(self):
+        filepath = self.add_file("in-mail.pdf")
+        lost_filepath = self.add_file("in-lost.pdf")
+        with open(os.path.join(self.fs_root, JOURNAL_FILENAME), "w") as fd:
+            # a committed document whose file was not moved yet
+            fd.write(json.dumps({"document": "/plone/incoming-mails", "files": [filepath]}) + "\n")
+            # a document of a batch that was never committed
+            fd.write(json.dumps({"document": "/plone/incoming-mails/lost", "files": [lost_filepath]}) + "\n")
+        self.assertEqual(self.run_import(), "OK (1 imported files, 0 unprocessed files)")
+        self.assertTrue(os.path.exists(os.path.join(self.processed_root, "incoming-mails", "in-mail.pdf")))
+        self.assertIn("lost", self.folder)
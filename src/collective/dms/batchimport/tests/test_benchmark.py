@@ -0,0 +1,68 @@
+from collective.dms.batchimport.testing import FUNCTIONAL
+from collective.dms.batchimport.tests import benchmark
+from plone import api
+from plone.app.testing import setRoles
+from plone.app.testing import TEST_USER_ID
+from plone.registry.interfaces import IRegistry
+from zope.component import getUtility
+
+import json
+import shutil
+import sys
+import tempfile
+import unittest2 as unittest
+
+
+# per document cost allowed to grow between a small and a 4 times bigger import
+MAX_COST_RATIO = 2.0
+
+
+class TestImportScaling(unittest.TestCase):
+    """Benchmarks, run with `bin/test -a 2`."""
+
+    layer = FUNCTIONAL
+    level = 2
+
+    def setUp(self):
+        self.portal = self.layer["portal"]
+        self.request = self.layer["request"]
+        setRoles(self.portal, TEST_USER_ID, ["Manager"])
+        getUtility(IRegistry)["collective.dms.batchimport.batchimport.ISettings.code_to_type_mapping"] = [
+            {"code": u"in", "portal_type": u"dmsincomingmail"}
+        ]
+        self.directories = []
+
+    def tearDown(self):
+        for directory in self.directories:
+            shutil.rmtree(directory)
+
+    def report(self, name, measures):
+        sys.stderr.write("\n%s: %s\n" % (name, json.dumps(measures, indent=2, sort_keys=True)))
+
+    def import_tree(self, **tree_options):
+        fs_root = tempfile.mkdtemp()
+        processed_root = tempfile.mkdtemp()
+        self.directories.extend([fs_root, processed_root])
+        benchmark.create_folders(self.portal, benchmark.generate_tree(fs_root, **tree_options))
+        return benchmark.benchmark_batchimport(self.portal, self.request, fs_root, processed_root)
+
+    def test_batchimport_scaling(self):
+        small = self.import_tree(dirs=2, files=50, metadata_ratio=0.5, duplicate_ratio=0.05)
+        big = self.import_tree(dirs=2, files=200, metadata_ratio=0.5, duplicate_ratio=0.05, folder_prefix="big")
+        self.report("small import", small)
+        self.report("big import", big)
+        self.assertEqual(big["documents"], 400)
+        self.assertLess(big["per_document"], small["per_document"] * MAX_COST_RATIO)
+
+    def test_batchimport_deep_tree(self):
+        measures = self.import_tree(depth=3, dirs=3, files=5, size=64 * 1024)
+        self.report("deep tree import", measures)
+        self.assertEqual(measures["documents"], (3 + 9 + 27) * 5)
+
+    def test_create_document_scaling(self):
+        folder = api.content.create(container=self.portal, type="Folder", id="benchmark")
+        small = benchmark.benchmark_create_document(self.portal, self.request, folder, 100)
+        big = benchmark.benchmark_create_document(self.portal, self.request, folder, 400)
+        self.report("small createDocument", small)
+        self.report("big createDocument", big)
+        self.assertLess(big["per_document"], small["per_document"] * MAX_COST_RATIO)
@@ -0,0 +1,61 @@
+from collective.dms.batchimport.claims import DirectoryClaims
+from collective.dms.batchimport.claims import ImportLock
+from collective.dms.batchimport.claims import SharedImportLock
+
+import os
+import shutil
+import tempfile
+import time
+import unittest2 as unittest
+
+
+class TestDirectoryClaims(unittest.TestCase):
+    def setUp(self):
+        self.fs_root = tempfile.mkdtemp()
+        self.claims = DirectoryClaims(self.fs_root, timeout=60, worker_id="worker-1")
+        self.other_claims = DirectoryClaims(self.fs_root, timeout=60, worker_id="worker-2")
+
+    def tearDown(self):
+        shutil.rmtree(self.fs_root)
+
+    def test_claim(self):
+        self.assertTrue(self.claims.claim("folder"))
+        self.assertTrue(self.claims.claim("folder"))
+        self.assertFalse(self.other_claims.claim("folder"))
+        self.assertTrue(self.other_claims.claim("other folder"))
+
+    def test_release(self):
+        self.claims.claim("folder")
+        self.claims.release("folder")
+        self.assertTrue(self.other_claims.claim("folder"))
+        self.other_claims.release_all()
+        self.assertEqual(os.listdir(self.claims.claims_directory), [])
+
+    def test_abandoned_claim(self):
+        self.claims.claim("folder")
+        past = time.time() - 120
+        os.utime(self.claims.get_lock_path("folder"), (past, past))
+        self.assertTrue(self.other_claims.claim("folder"))
+        self.assertFalse(self.claims.is_stale(self.claims.get_lock_path("folder")))
+
+    def test_import_lock(self):
+        lock = ImportLock(self.fs_root)
+        other_lock = ImportLock(self.fs_root)
+        self.assertTrue(lock.acquire())
+        self.assertFalse(other_lock.acquire())
+        # directories are still claimed separately
+        self.assertTrue(self.claims.claim("folder"))
+        lock.release()
+        self.assertTrue(other_lock.acquire())
+
+    def test_shared_import_lock(self):
+        lock = SharedImportLock(self.fs_root)
+        other_lock = SharedImportLock(self.fs_root)
+        self.assertTrue(lock.acquire())
+        self.assertTrue(other_lock.acquire())
+        # but not while an import holds the root directory alone
+        exclusive_lock = ImportLock(self.fs_root)
+        self.assertTrue(exclusive_lock.acquire())
+        self.assertFalse(lock.acquire())
+        exclusive_lock.release()
+        self.assertTrue(lock.acquire())
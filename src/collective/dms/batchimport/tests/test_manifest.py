@@ -0,0 +1,50 @@
+from collective.dms.batchimport.manifest import ERROR
+from collective.dms.batchimport.manifest import get_signature
+from collective.dms.batchimport.manifest import IMPORTED
+from collective.dms.batchimport.manifest import ScanManifest
+
+import os
+import shutil
+import tempfile
+import unittest2 as unittest
+
+
+class TestScanManifest(unittest.TestCase):
+    def setUp(self):
+        self.fs_root = tempfile.mkdtemp()
+        self.manifest_filepath = os.path.join(self.fs_root, ".manifest")
+        self.filepath = os.path.join(self.fs_root, "in-mail.pdf")
+        with open(self.filepath, "w") as fd:
+            fd.write("scanned mail")
+
+    def tearDown(self):
+        shutil.rmtree(self.fs_root)
+
+    def test_reload(self):
+        manifest = ScanManifest(self.manifest_filepath)
+        signature = get_signature(self.filepath)
+        self.assertFalse(manifest.is_unchanged(u"in-mail.pdf", signature))
+        manifest.set(u"in-mail.pdf", signature, ERROR)
+        manifest.set(u"in-mail.pdf", signature, IMPORTED)
+        manifest.set(u"other.pdf", signature, IMPORTED)
+        manifest.discard(u"other.pdf")
+        manifest.flush()
+        with open(self.manifest_filepath, "a") as fd:
+            fd.write('["truncated", ')
+        manifest = ScanManifest(self.manifest_filepath)
+        self.assertEqual(manifest.entries, {u"in-mail.pdf": (signature, IMPORTED)})
+        self.assertTrue(manifest.is_unchanged(u"in-mail.pdf", signature))
+
+    def test_modified(self):
+        manifest = ScanManifest(self.manifest_filepath)
+        manifest.set(u"in-mail.pdf", get_signature(self.filepath), IMPORTED)
+        with open(self.filepath, "a") as fd:
+            fd.write("rescanned")
+        self.assertFalse(manifest.is_unchanged(u"in-mail.pdf", get_signature(self.filepath)))
+
+    def test_save(self):
+        manifest = ScanManifest(self.manifest_filepath)
+        manifest.set(u"in-mail.pdf", get_signature(self.filepath), IMPORTED)
+        manifest.set(u"moved.pdf", [1, 1], IMPORTED)
+        manifest.save(self.fs_root)
+        self.assertEqual(list(ScanManifest(self.manifest_filepath).entries), [u"in-mail.pdf"])
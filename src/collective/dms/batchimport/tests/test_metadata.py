@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from collective.dms.batchimport.metadata import MetadataError
+from collective.dms.batchimport.metadata import read_directory_metadata
+
+import os
+import shutil
+import tempfile
+import unittest2 as unittest
+
+
+class TestDirectoryMetadata(unittest.TestCase):
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirpath)
+
+    def write(self, filename, data):
+        with open(os.path.join(self.dirpath, filename), "w") as fd:
+            fd.write(data)
+
+    def test_no_metadata(self):
+        self.assertIsNone(read_directory_metadata(self.dirpath))
+
+    def test_jsonl(self):
+        self.write(
+            "metadata.jsonl",
+            '{"filename": "in-mail 1.pdf", "title": "First mail"}\n'
+            "\n"
+            '{"filename": "in-mail 2.pdf", "title": "Second"}\n',
+        )
+        self.assertEqual(
+            read_directory_metadata(self.dirpath),
+            {u"in-mail 1.pdf": {u"title": u"First mail"}, u"in-mail 2.pdf": {u"title": u"Second"}},
+        )
+
+    def test_csv(self):
+        self.write("metadata.csv", "filename,title,description\nin-mail 1.pdf,Réponse,\n")
+        self.assertEqual(read_directory_metadata(self.dirpath), {u"in-mail 1.pdf": {u"title": u"Réponse"}})
+
+    def test_invalid(self):
+        self.write("metadata.jsonl", '{"filename": "in-mail 1.pdf"}\n{"title": "no filename"}\n')
+        self.assertRaises(MetadataError, read_directory_metadata, self.dirpath)
+        self.write("metadata.jsonl", '{"filename": "in-mail 1.pdf"\n')
+        self.assertRaises(MetadataError, read_directory_metadata, self.dirpath)
@@ -0,0 +1,46 @@
+from collective.dms.batchimport.pipeline import Prefetcher
+
+import threading
+import time
+import unittest2 as unittest
+
+
+class TestPrefetcher(unittest.TestCase):
+    def test_order(self):
+        def prepare(item):
+            time.sleep(0.001 * (10 - item))
+            return item * 2
+
+        self.assertEqual(list(Prefetcher(prepare, range(10), workers=4)), [x * 2 for x in range(10)])
+
+    def test_without_workers(self):
+        threads = set()
+
+        def prepare(item):
+            threads.add(threading.current_thread())
+            return item
+
+        self.assertEqual(list(Prefetcher(prepare, range(3), workers=0)), [0, 1, 2])
+        self.assertEqual(threads, set([threading.current_thread()]))
+
+    def test_bounded(self):
+        consumed = []
+
+        def items():
+            for item in range(100):
+                consumed.append(item)
+                yield item
+
+        results = iter(Prefetcher(lambda item: item, items(), workers=2, depth=3))
+        self.assertEqual(next(results), 0)
+        self.assertEqual(len(consumed), 4)
+
+    def test_error(self):
+        def prepare(item):
+            if item == 2:
+                raise ValueError(item)
+            return item
+
+        results = iter(Prefetcher(prepare, range(5), workers=2))
+        self.assertEqual([next(results), next(results)], [0, 1])
+        self.assertRaises(ValueError, next, results)
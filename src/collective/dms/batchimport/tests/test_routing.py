@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+from collective.dms.batchimport import routing
+from collective.dms.batchimport.routing import Router
+from collective.dms.batchimport.routing import RoutingError
+
+import unittest2 as unittest
+
+
+MAPPING = [{"code": u"in", "portal_type": u"dmsincomingmail"}, {"code": u"out", "portal_type": u"dmsoutgoingmail"}]
+
+
+class TestRouter(unittest.TestCase):
+    def test_code_mapping(self):
+        router = Router(code_to_type_mapping=MAPPING)
+        route, name = router.route(u"incoming-mails", u"in-mail.pdf")
+        self.assertEqual(
+            (route.portal_type, route.mainfile_type, name), (u"dmsincomingmail", "dmsmainfile", u"mail.pdf")
+        )
+        self.assertIsNone(router.route(u"incoming-mails", u"other-mail.pdf"))
+        self.assertIsNone(router.route(u"incoming-mails", u"inmail.pdf"))
+        self.assertEqual(router.portal_types, set([u"dmsincomingmail", u"dmsoutgoingmail"]))
+
+    def test_rules(self):
+        rules = [
+            {"match": u"code", "pattern": u"in", "folder": u"invoices", "portal_type": u"invoice", "owner": u"bob"},
+            {"match": u"prefix", "pattern": u"SCAN_", "portal_type": u"dmsincomingmail", "metadata": u'{"a": 1}'},
+            {"match": u"regex", "pattern": u"(?P<name>.+)\\.eml$", "portal_type": u"email", "mainfile_type": u"eml"},
+        ]
+        router = Router(rules, MAPPING)
+        route, name = router.route(u"invoices/2024", u"in-bill.pdf")
+        self.assertEqual((route.portal_type, route.owner, name), (u"invoice", u"bob", u"bill.pdf"))
+        # the rule is restricted to its directory, the mapping applies elsewhere
+        self.assertEqual(router.route(u"incoming-mails", u"in-bill.pdf")[0].portal_type, u"dmsincomingmail")
+        route, name = router.route(u"", u"SCAN_0001.pdf")
+        self.assertEqual((route.portal_type, route.metadata, name), (u"dmsincomingmail", {u"a": 1}, u"0001.pdf"))
+        route, name = router.route(u"", u"mail.eml")
+        self.assertEqual((route.portal_type, route.mainfile_type, name), (u"email", u"eml", u"mail"))
+        # the first matching rule wins
+        route, name = router.route(u"invoices", u"SCAN_in-bill.eml")
+        self.assertEqual(route.portal_type, u"dmsincomingmail")
+
+    def test_invalid_rules(self):
+        for rule in (
+            {"match": u"regex", "pattern": u"(", "portal_type": u"email"},
+            {"match": u"code", "pattern": u"in", "portal_type": u"email", "metadata": u"[1]"},
+            {"match": u"suffix", "pattern": u".pdf", "portal_type": u"email"},
+        ):
+            self.assertRaises(RoutingError, Router, [rule])
+
+    def test_get_router(self):
+        router = routing.get_router(None, MAPPING)
+        self.assertIs(routing.get_router(None, list(MAPPING)), router)
+        self.assertIsNot(routing.get_router(None, MAPPING[:1]), router)
@@ -0,0 +1,35 @@
+from collective.dms.batchimport.stats import ImportStats
+from collective.dms.batchimport.stats import percentile
+from collective.dms.batchimport.stats import timer
+
+import unittest2 as unittest
+
+
+class TestImportStats(unittest.TestCase):
+    def test_percentile(self):
+        durations = [float(x) for x in range(1, 11)]
+        self.assertEqual(percentile(durations, 50), 5.0)
+        self.assertEqual(percentile(durations, 90), 9.0)
+        self.assertEqual(percentile(durations, 99), 10.0)
+        self.assertEqual(percentile([], 50), 0.0)
+
+    def test_report(self):
+        stats = ImportStats()
+        for i in range(4):
+            with stats.timer("create"):
+                pass
+            stats.add_file(100)
+        with timer(None, "ignored"):
+            pass
+        report = stats.report()
+        self.assertEqual(report["files"], 4)
+        self.assertEqual(report["bytes"], 400)
+        self.assertEqual(list(report["stages"]), ["create"])
+        self.assertEqual(report["stages"]["create"]["count"], 4)
+
+    def test_timer_error(self):
+        stats = ImportStats()
+        with self.assertRaises(ValueError):
+            with timer(stats, "create"):
+                raise ValueError()
+        self.assertEqual(len(stats.durations["create"]), 1)
@@ -0,0 +1,88 @@
+from collective.dms.batchimport.batchimport import ISettings
+from collective.dms.batchimport.testing import FUNCTIONAL
+from plone import api
+from plone.app.testing import setRoles
+from plone.app.testing import TEST_USER_ID
+from plone.registry.interfaces import IRegistry
+from StringIO import StringIO
+from zope.component import getMultiAdapter
+from zope.component import getUtility
+
+import json
+import os
+import shutil
+import tempfile
+import unittest2 as unittest
+
+
+class Upload(StringIO):
+    def __init__(self, filename, data="%PDF-1.4 scanned mail"):
+        StringIO.__init__(self, data)
+        self.filename = filename
+
+
+class TestUploads(unittest.TestCase):
+
+    layer = FUNCTIONAL
+
+    def setUp(self):
+        self.portal = self.layer["portal"]
+        self.request = self.layer["request"]
+        setRoles(self.portal, TEST_USER_ID, ["Manager"])
+        self.folder = api.content.create(container=self.portal, type="Folder", id="incoming-mails")
+        self.spool = tempfile.mkdtemp()
+        self.settings = getUtility(IRegistry).forInterface(ISettings, False)
+        self.settings.upload_spool_directory = self.spool.decode("utf8")
+
+    def tearDown(self):
+        shutil.rmtree(self.spool)
+
+    def call(self, name, **form):
+        self.request.form = form
+        self.request.response.setStatus(200)
+        result = json.loads(getMultiAdapter((self.portal, self.request), name=name)())
+        return self.request.response.getStatus(), result
+
+    def test_bulk(self):
+        status, result = self.call(
+            "fileimport-bulk",
+            files=[Upload("mail 1.pdf"), Upload("C:\\scans\\mail 2.pdf"), Upload("mail 3.pdf")],
+            metadata=json.dumps([{"title": u"First mail"}, {}, {"location": u"unknown"}]),
+            portal_type="dmsincomingmail",
+            location="incoming-mails",
+        )
+        self.assertEqual(status, 200)
+        self.assertEqual((result["imported"], result["errors"]), (2, 1))
+        self.assertEqual(
+            [upload["filename"] for upload in result["files"]], [u"mail 1.pdf", u"mail 2.pdf", u"mail 3.pdf"]
+        )
+        self.assertEqual(result["files"][2]["error"], "folder unknown not found")
+        self.assertEqual(sorted(document.title for document in self.folder.objectValues()), [u"First mail", u"mail-2"])
+
+    def test_chunked(self):
+        status, result = self.call(
+            "fileimport-chunked",
+            action="start",
+            filename="mail.pdf",
+            size="21",
+            portal_type="dmsincomingmail",
+            location="incoming-mails",
+        )
+        upload_id = result["upload_id"]
+        chunk = {"action": "chunk", "upload_id": upload_id, "offset": "0", "chunk": "%PDF-1.4 "}
+        status, result = self.call("fileimport-chunked", **chunk)
+        self.assertEqual(result["offset"], 9)
+        # a chunk resent after a lost response is refused with the offset to resume from
+        status, result = self.call("fileimport-chunked", **chunk)
+        self.assertEqual((status, result["offset"]), (409, 9))
+        status, result = self.call("fileimport-chunked", action="finish", upload_id=upload_id)
+        self.assertEqual(status, 409)
+        status, result = self.call(
+            "fileimport-chunked", action="chunk", upload_id=upload_id, offset="9", chunk=Upload("", "scanned mail")
+        )
+        self.assertEqual(self.call("fileimport-chunked", action="status", upload_id=upload_id)[1]["offset"], 21)
+        status, result = self.call("fileimport-chunked", action="finish", upload_id=upload_id)
+        self.assertEqual((status, result["path"]), (200, "/plone/incoming-mails/mail"))
+        self.assertEqual(self.folder["mail"].objectValues()[0].file.data, "%PDF-1.4 scanned mail")
+        self.assertEqual(os.listdir(self.spool), [])
+        self.assertEqual(self.call("fileimport-chunked", action="status", upload_id=upload_id)[0], 404)
@@ -0,0 +1,78 @@
+from collective.dms.batchimport.watcher import Watcher
+
+import os
+import shutil
+import tempfile
+import time
+import unittest2 as unittest
+
+
+class TestWatcher(unittest.TestCase):
+    def setUp(self):
+        self.fs_root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.fs_root, "incoming-mails"))
+        self.watcher = Watcher(self.fs_root, settle=60, use_inotify=False)
+
+    def tearDown(self):
+        shutil.rmtree(self.fs_root)
+
+    def add_file(self, path, data="scanned mail"):
+        with open(os.path.join(self.fs_root, path), "a") as fd:
+            fd.write(data)
+
+    def settle(self):
+        # as if all files had been unchanged for long enough
+        for path, (signature, since) in self.watcher.candidates.items():
+            self.watcher.candidates[path] = (signature, since - self.watcher.settle)
+
+    def test_stable_files(self):
+        self.add_file("incoming-mails/in-mail.pdf")
+        self.add_file("incoming-mails/in-mail.pdf.metadata", "{}")
+        self.add_file("incoming-mails/.hidden")
+        self.watcher.scan()
+        self.assertEqual(self.watcher.pop_ready(), [])
+        self.settle()
+        self.assertEqual(
+            self.watcher.pop_ready(), ["incoming-mails/in-mail.pdf.metadata", "incoming-mails/in-mail.pdf"]
+        )
+        # not reported again while unchanged
+        self.watcher.scan()
+        self.assertEqual(self.watcher.candidates, {})
+
+    def test_growing_file(self):
+        self.add_file("incoming-mails/in-mail.pdf")
+        self.watcher.scan()
+        self.settle()
+        self.add_file("incoming-mails/in-mail.pdf", " and more")
+        os.utime(os.path.join(self.fs_root, "incoming-mails/in-mail.pdf"), (time.time() + 1, time.time() + 1))
+        self.watcher.scan()
+        self.assertEqual(self.watcher.pop_ready(), [])
+
+    def test_waiting_metadata(self):
+        self.add_file("incoming-mails/in-mail.pdf")
+        self.watcher.scan()
+        self.settle()
+        self.add_file("incoming-mails/in-mail.pdf.metadata", "{}")
+        self.add_file("incoming-mails/in-other.pdf.metadata", "{}")
+        self.watcher.scan()
+        self.assertEqual(self.watcher.pop_ready(), [])
+        self.settle()
+        self.assertEqual(
+            self.watcher.pop_ready(), ["incoming-mails/in-mail.pdf.metadata", "incoming-mails/in-mail.pdf"]
+        )
+        # a metadata file waits for its file
+        self.assertEqual(list(self.watcher.candidates), ["incoming-mails/in-other.pdf.metadata"])
+
+    def test_max_files(self):
+        self.watcher.max_files = 2
+        for i in range(3):
+            self.add_file("incoming-mails/in-mail %s.pdf" % i)
+        self.watcher.scan()
+        self.settle()
+        self.assertEqual(len(self.watcher.pop_ready()), 2)
+        self.assertEqual(self.watcher.pop_ready(), ["incoming-mails/in-mail 2.pdf"])
+
+    def test_polling(self):
+        self.watcher.settle = 0
+        self.add_file("incoming-mails/in-mail.pdf")
+        self.assertEqual(next(iter(self.watcher)), ["incoming-mails/in-mail.pdf"])
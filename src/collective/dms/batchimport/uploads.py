@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""Bulk and chunked uploads, next to the @@fileimport form.
+
+``@@fileimport-bulk`` creates a document for each file of the ``files``
+field of a multipart request, committing them by batches of the
+``batch_size`` setting. The json object at the position of a file in the
+``metadata`` field describes it (``title``, ``portal_type``, ``location``,
+``owner`` and other metadata), the ``portal_type``, ``location`` and
+``owner`` fields give the defaults.
+
+``@@fileimport-chunked`` receives a large file by chunks in the spool
+directory, so that an interrupted upload resumes where it stopped. Its
+``action`` is ``start``, ``status``, ``chunk``, ``finish`` or ``cancel``.
+"""
+from collective.dms.batchimport import utils
+from collective.dms.batchimport.batchimport import ISettings
+from five import grok
+from plone import api
+from plone.i18n.normalizer.interfaces import IIDNormalizer
+from plone.registry.interfaces import IRegistry
+from Products.CMFPlone.interfaces import IPloneSiteRoot
+from Products.CMFPlone.utils import safe_unicode
+from ZODB.POSException import ConflictError
+from zope.component import getUtility
+from zope.component import queryUtility
+from zope.interface import Invalid
+
+import json
+import logging
+import os
+import re
+import shutil
+import transaction
+import uuid
+
+
+log = logging.getLogger("collective.dms.batchimport")
+
+# fields describing a document besides its metadata
+DOCUMENT_FIELDS = ("portal_type", "location", "owner")
+
+UPLOAD_ID = re.compile(r"^[0-9a-f]{32}$")
+
+
+class UploadError(Exception):
+    def __init__(self, message, status=400, **data):
+        super(UploadError, self).__init__(message)
+        self.status = status
+        self.data = data
+
+
+def get_message(error):
+    if error.args and isinstance(error.args[0], basestring):
+        return error.args[0]
+    return str(error)
+
+
+def get_filename(upload):
+    # some browsers send the full path of the file
+    return os.path.basename(safe_unicode(upload.filename or u"").replace(u"\\", u"/"))
+
+
+class UploadView(grok.View):
+    """Create documents from uploaded files, answering in json."""
+
+    grok.baseclass()
+    grok.context(IPloneSiteRoot)
+    grok.require("cmf.ManagePortal")
+
+    def update(self):
+        self.settings = getUtility(IRegistry).forInterface(ISettings, False)
+        self.folders = utils.FolderResolver(self.context)
+        self.owners = utils.OwnerCache(self.context)
+        try:
+            self.result = self.handle()
+        except UploadError as e:
+            transaction.abort()
+            self.request.response.setStatus(e.status)
+            self.result = dict(e.data, error=get_message(e))
+        finally:
+            self.owners.release()
+
+    def render(self):
+        self.request.response.setHeader("Content-Type", "application/json")
+        return json.dumps(self.result)
+
+    def get_defaults(self):
+        return dict((key, self.request.form[key]) for key in DOCUMENT_FIELDS if self.request.form.get(key))
+
+    def get_metadata(self):
+        try:
+            metadata = json.loads(self.request.form.get("metadata") or "null")
+        except ValueError as e:
+            raise UploadError("invalid metadata (%s)" % e)
+        return metadata
+
+    def import_file(self, filename, file_object, data):
+        """Create the document of an uploaded file, return its path."""
+        data = dict(data)
+        portal_type = data.pop("portal_type", None)
+        if not portal_type:
+            raise UploadError("no portal type")
+        location = data.pop("location", None) or u""
+        folder = self.folders.resolve(location)
+        if folder is None:
+            raise UploadError("folder %s not found" % location)
+        owner = data.pop("owner", None)
+        document_id = queryUtility(IIDNormalizer).normalize(os.path.splitext(filename)[0])
+        document, version = utils.createDocument(
+            self, folder, portal_type, document_id, file_object, owner=owner, metadata=data, owners=self.owners
+        )
+        return "/".join(document.getPhysicalPath())
+
+
+class BulkImportView(UploadView):
+    """Import the files of a multipart request, each one with its own metadata."""
+
+    grok.name("fileimport-bulk")
+
+    def handle(self):
+        uploads = self.request.form.get("files") or []
+        if not isinstance(uploads, list):
+            uploads = [uploads]
+        metadata = self.get_metadata() or []
+        if not isinstance(metadata, list) or not all(isinstance(data, dict) for data in metadata):
+            raise UploadError("metadata must be a list of objects")
+        defaults = self.get_defaults()
+        batch_size = self.settings.batch_size or 100
+        results = []
+        nb_created = 0
+        for number, upload in enumerate(uploads):
+            filename = get_filename(upload)
+            data = dict(defaults)
+            if number < len(metadata):
+                data.update(metadata[number])
+            savepoint = transaction.savepoint(optimistic=True)
+            try:
+                path = self.import_file(filename, utils.createBlobFileFromStream(upload, filename), data)
+            except ConflictError:
+                raise
+            except Exception as e:
+                savepoint.rollback()
+                log.warning(u"error importing uploaded file %s (%s)" % (filename, get_message(e)))
+                results.append({"filename": filename, "error": get_message(e)})
+                continue
+            results.append({"filename": filename, "path": path})
+            nb_created += 1
+            if nb_created % batch_size == 0:
+                transaction.commit()
+        return {"files": results, "imported": nb_created, "errors": len(results) - nb_created}
+
+
+class ChunkedUploadView(UploadView):
+    """Receive a file by chunks, appended at the offset the client gives, then import it."""
+
+    grok.name("fileimport-chunked")
+
+    def handle(self):
+        self.spool_directory = self.settings.upload_spool_directory
+        if not self.spool_directory:
+            raise UploadError("no upload spool directory is configured")
+        action = self.request.form.get("action")
+        if action == "start":
+            return self.start()
+        upload_id = self.request.form.get("upload_id") or ""
+        if not UPLOAD_ID.match(upload_id):
+            raise UploadError("invalid upload id")
+        record_filepath = os.path.join(self.spool_directory, upload_id + ".json")
+        if not os.path.exists(record_filepath):
+            raise UploadError("unknown upload %s" % upload_id, status=404)
+        with open(record_filepath) as fd:
+            record = json.load(fd)
+        if record["user"] != api.user.get_current().getId():
+            raise UploadError("upload %s was started by another user" % upload_id, status=403)
+        part_filepath = os.path.join(self.spool_directory, upload_id + ".part")
+        offset = os.path.getsize(part_filepath)
+        if action == "status":
+            return {"upload_id": upload_id, "offset": offset, "size": record["size"]}
+        if action == "chunk":
+            return {"upload_id": upload_id, "offset": self.append_chunk(part_filepath, offset)}
+        if action == "finish":
+            if record["size"] is not None and offset != record["size"]:
+                raise UploadError("upload %s is incomplete" % upload_id, status=409, offset=offset)
+            result = {"upload_id": upload_id, "path": self.finish(part_filepath, record)}
+        elif action == "cancel":
+            result = {"upload_id": upload_id}
+        else:
+            raise UploadError("unknown action %s" % action)
+        os.remove(part_filepath)
+        os.remove(record_filepath)
+        return result
+
+    def start(self):
+        filename = safe_unicode(self.request.form.get("filename") or u"")
+        if not filename:
+            raise UploadError("no filename")
+        size = self.request.form.get("size")
+        if size and not size.isdigit():
+            raise UploadError("invalid size %s" % size)
+        metadata = self.get_metadata() or {}
+        if not isinstance(metadata, dict):
+            raise UploadError("metadata must be an object")
+        data = self.get_defaults()
+        data.update(metadata)
+        upload_id = uuid.uuid4().hex
+        record = {
+            "filename": os.path.basename(filename.replace(u"\\", u"/")),
+            "size": int(size) if size else None,
+            "data": data,
+            "user": api.user.get_current().getId(),
+        }
+        if not os.path.exists(self.spool_directory):
+            os.makedirs(self.spool_directory)
+        open(os.path.join(self.spool_directory, upload_id + ".part"), "wb").close()
+        with open(os.path.join(self.spool_directory, upload_id + ".json"), "w") as fd:
+            json.dump(record, fd)
+        return {"upload_id": upload_id, "offset": 0}
+
+    def finish(self, part_filepath, record):
+        file_object = utils.createBlobFile(part_filepath, record["filename"], link=bool(self.settings.hardlink_blobs))
+        try:
+            path = self.import_file(record["filename"], file_object, record["data"])
+        except Invalid as e:
+            raise UploadError(get_message(e))
+        # the spooled file is only removed once its document is committed
+        transaction.commit()
+        return path
+
+    def append_chunk(self, part_filepath, offset):
+        """Append the chunk sent at offset, return the new size of the spooled file."""
+        chunk = self.request.form.get("chunk")
+        if chunk is None:
+            raise UploadError("no chunk")
+        if str(offset) != self.request.form.get("offset"):
+            # the client resumes from the size actually received
+            raise UploadError("chunk sent at a wrong offset", status=409, offset=offset)
+        with open(part_filepath, "ab") as fd:
+            if isinstance(chunk, basestring):
+                fd.write(chunk)
+            else:
+                shutil.copyfileobj(chunk, fd, utils.BLOB_CHUNK_SIZE)
+        return os.path.getsize(part_filepath)
@@ -1,12 +1,24 @@
+from AccessControl.SecurityManagement import getSecurityManager
+from AccessControl.SecurityManagement import newSecurityManager
+from AccessControl.SecurityManagement import setSecurityManager
+from Acquisition import aq_base
+from Acquisition import aq_chain
 from collective.dms.mailcontent.dmsmail import internalReferenceIncomingMailDefaultValue
 from collective.dms.mailcontent.dmsmail import internalReferenceOutgoingMailDefaultValue
 from collective.dms.mailcontent.dmsmail import receptionDateDefaultValue
+from contextlib import contextmanager
 from imio.helpers.content import find
 from plone import api
+from plone.api.exc import InvalidParameterError
 from plone.dexterity.utils import createContentInContainer
+from plone.namedfile.file import NamedBlobFile
+from Products.CMFCore.utils import getToolByName
 from zope.interface import Invalid
 
+import fnmatch
 import logging
+import os
+import shutil
 
 
 try:
@@ -16,16 +28,96 @@ except ImportError:
     IDeadline = None
 
 from . import _
+from . import indexing
+from .stats import timer
 
 
 log = logging.getLogger("collective.dms.batchimport")
 
+BLOB_CHUNK_SIZE = 1 << 16
+
+
+def get_rss():
+    """Return the resident memory of the process in bytes, None where /proc is not available."""
+    try:
+        with open("/proc/self/statm") as fd:
+            return int(fd.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+
+
+def createBlobFile(filepath, filename, link=False, hasher=None):
+    """Create a NamedBlobFile from a file on disk without loading it in memory.
+
+    With link, the file is hard linked and the link is consumed by the blob
+    storage, which avoids any copy when both are on the same filesystem.
+    hasher, e.g. hashlib.sha256(), is updated with the content of the file.
+    """
+    blob_file = NamedBlobFile(filename=filename)
+    if link:
+        link_path = os.path.join(
+            os.path.dirname(filepath), ".%s.%s.blob" % (os.path.basename(filepath), os.getpid())
+        )
+        try:
+            os.link(filepath, link_path)
+        except OSError as e:
+            log.warning("cannot link %s, copying it (%s)" % (filepath, e))
+        else:
+            if hasher is not None:
+                with open(filepath, "rb") as source:
+                    for chunk in iter(lambda: source.read(BLOB_CHUNK_SIZE), ""):
+                        hasher.update(chunk)
+            blob_file._blob.consumeFile(link_path)
+            return blob_file
+    with open(filepath, "rb") as source:
+        return createBlobFileFromStream(source, filename, blob_file, hasher=hasher)
+
+
+def createBlobFileFromStream(source, filename, blob_file=None, hasher=None):
+    """Create a NamedBlobFile from a file object, copied by chunks."""
+    if blob_file is None:
+        blob_file = NamedBlobFile(filename=filename)
+    target = blob_file.open("w")
+    try:
+        if hasher is None:
+            shutil.copyfileobj(source, target, BLOB_CHUNK_SIZE)
+        else:
+            for chunk in iter(lambda: source.read(BLOB_CHUNK_SIZE), ""):
+                hasher.update(chunk)
+                target.write(chunk)
+    finally:
+        target.close()
+    return blob_file
+
+
+def pathMatches(path, patterns):
+    """Tell if a path relative to the root directory matches one of the patterns, or is in a matching directory."""
+    for pattern in patterns:
+        if fnmatch.fnmatch(path, pattern) or path.startswith(pattern + "/"):
+            return True
+    return False
+
 
 def createDocument(
-    context, folder, portal_type, title, file_object, mainfile_type="dmsmainfile", owner=None, metadata=None
+    context,
+    folder,
+    portal_type,
+    title,
+    file_object,
+    mainfile_type="dmsmainfile",
+    owner=None,
+    metadata=None,
+    index=None,
+    references=None,
+    stats=None,
+    owners=None,
 ):
-    if owner is None:
-        owner = api.user.get_current().id
+    if owners is not None:
+        adopted = owners.adopt(owner)
+    else:
+        if owner is None:
+            owner = api.user.get_current().id
+        adopted = api.env.adopt_user(username=owner)
 
     if not metadata:
         metadata = {}
@@ -33,6 +125,16 @@ def createDocument(
     if "title" not in metadata and title:
         metadata["title"] = title
 
+    if references is not None and "internal_reference_no" not in metadata:
+        with timer(stats, "reference"):
+
+            def is_used(reference):
+                return index is not None and index.has_reference_number(portal_type, reference)
+
+            internal_reference_no = references.allocate(portal_type, is_used=is_used)
+        if internal_reference_no is not None:
+            metadata["internal_reference_no"] = internal_reference_no
+
     if portal_type.startswith("dmsincoming"):
         if "internal_reference_no" not in metadata:
             metadata["internal_reference_no"] = internalReferenceIncomingMailDefaultValue(context)
@@ -42,9 +144,18 @@ def createDocument(
         if "internal_reference_no" not in metadata:
             metadata["internal_reference_no"] = internalReferenceOutgoingMailDefaultValue(context)
     if "internal_reference_no" in metadata:
-        if find(
-            unrestricted=True, portal_type=portal_type, internal_reference_number=metadata["internal_reference_no"]
-        ):
+        with timer(stats, "duplicate_check"):
+            if index is not None:
+                exists = index.has_reference_number(portal_type, metadata["internal_reference_no"])
+            else:
+                # documents whose indexing is deferred must be found too
+                indexing.flush()
+                exists = find(
+                    unrestricted=True,
+                    portal_type=portal_type,
+                    internal_reference_number=metadata["internal_reference_no"],
+                )
+        if exists:
             raise Invalid(
                 api.portal.translate(
                     _(
@@ -60,13 +171,167 @@ def createDocument(
         file_title = metadata["file_title"]
         del metadata["file_title"]
 
-    with api.env.adopt_user(username=owner):
-        document = createContentInContainer(folder, portal_type, **metadata)
+    with adopted:
+        with timer(stats, "create"):
+            document = createContentInContainer(folder, portal_type, **metadata)
         log.info("document has been created (id: %s)" % document.id)
 
         if IDeadline and IDeadline.providedBy(document):
             document.deadline = deadlineDefaultValue(None)
 
-        version = createContentInContainer(document, mainfile_type, title=file_title, file=file_object)
+        with timer(stats, "create_file"):
+            version = createContentInContainer(document, mainfile_type, title=file_title, file=file_object)
         log.info("file document has been created (id: %s)" % version.id)
+        if index is not None:
+            index.add(folder, document.id, portal_type, metadata.get("internal_reference_no"))
         return (document, version)
+
+
+class FolderResolver(object):
+    """Folders resolved from their path relative to the portal, cached for a whole import.
+
+    Acquisition is not used, so that a missing folder cannot resolve to an
+    item of one of its parents. Missing folders are cached as None.
+    """
+
+    def __init__(self, context):
+        self.folders = {"": getToolByName(context, "portal_url").getPortalObject()}
+
+    def resolve(self, foldername):
+        key = "/".join(part for part in foldername.split("/") if part)
+        if key not in self.folders:
+            parentname, _sep, part = key.rpartition("/")
+            parent = self.resolve(parentname)
+            folder = None
+            if parent is not None:
+                child = getattr(aq_base(parent), part, None)
+                if getattr(aq_base(child), "getId", None) is not None and child.getId() == part:
+                    folder = child.__of__(parent)
+            self.folders[key] = folder
+        return self.folders[key]
+
+
+class OwnerCache(object):
+    """Owners of imported documents, looked up once per import.
+
+    The security manager of an owner is kept while consecutive documents
+    have this owner, instead of being set up again for each one; release()
+    restores the original one.
+    """
+
+    def __init__(self, context):
+        self.portal = getToolByName(context, "portal_url").getPortalObject()
+        # username -> user wrapped in its user folder, None if not found
+        self.users = {}
+        self.owner = None
+        self.original = None
+
+    def get_user(self, username):
+        if username not in self.users:
+            self.users[username] = None
+            # from the portal up to the root, as plone.api does
+            for context in aq_chain(self.portal):
+                if getattr(aq_base(context), "acl_users", None) is None:
+                    continue
+                user = context.acl_users.getUser(username)
+                if user is not None:
+                    self.users[username] = user.__of__(context.acl_users)
+                    break
+        return self.users[username]
+
+    @contextmanager
+    def adopt(self, owner):
+        """Run as owner, or as the original user if None, and stay so afterwards."""
+        if owner != self.owner:
+            if self.original is None:
+                self.original = getSecurityManager()
+            if owner is None:
+                setSecurityManager(self.original)
+            else:
+                user = self.get_user(owner)
+                if user is None:
+                    raise InvalidParameterError("Cannot find a user with username '%s'" % owner)
+                newSecurityManager(None, user)
+            self.owner = owner
+        yield
+
+    def release(self):
+        if self.original is not None:
+            setSecurityManager(self.original)
+        self.original = None
+        self.owner = None
+
+
+class ImportIndex(object):
+    """Existing document ids and internal reference numbers, loaded once per import run.
+
+    Folder ids are read the first time a folder is used, internal reference
+    numbers of the given portal types with a single catalog query; both are
+    kept up to date with the documents created during the run.
+    """
+
+    def __init__(self, context, portal_types):
+        self.catalog = getToolByName(context, "portal_catalog")
+        self.portal_types = list(portal_types)
+        self.clear()
+
+    def clear(self):
+        """Forget everything, e.g. after an aborted transaction."""
+        self.folder_ids = {}
+        self.reference_numbers = None
+        # (folder path, document id, portal type, reference number) added in the current transaction
+        self.added = []
+
+    def savepoint(self):
+        """Return the state of the index, to restore along with a transaction savepoint."""
+        return len(self.added)
+
+    def rollback(self, state):
+        """Forget the documents added since the state was taken."""
+        for key, document_id, portal_type, reference_number in self.added[state:]:
+            if key in self.folder_ids:
+                self.folder_ids[key].discard(document_id)
+            if reference_number and self.reference_numbers is not None:
+                self.reference_numbers.get(portal_type, set()).discard(reference_number)
+        del self.added[state:]
+
+    def commit(self):
+        """Keep the documents added in the current transaction, which was committed."""
+        self.added = []
+
+    def get_folder_ids(self, folder):
+        key = folder.getPhysicalPath()
+        if key not in self.folder_ids:
+            self.folder_ids[key] = set(folder.objectIds())
+        return self.folder_ids[key]
+
+    def has_id(self, folder, document_id):
+        return document_id in self.get_folder_ids(folder)
+
+    def get_reference_numbers(self, portal_type):
+        if self.reference_numbers is None:
+            self.load_reference_numbers()
+        return self.reference_numbers.setdefault(portal_type, set())
+
+    def has_reference_number(self, portal_type, reference_number):
+        if portal_type not in self.portal_types:
+            self.portal_types.append(portal_type)
+            self.reference_numbers = None
+        return reference_number in self.get_reference_numbers(portal_type)
+
+    def load_reference_numbers(self):
+        self.reference_numbers = dict((portal_type, set()) for portal_type in self.portal_types)
+        if "internal_reference_number" not in self.catalog.indexes():
+            return
+        indexing.flush()
+        index = self.catalog._catalog.getIndex("internal_reference_number")
+        for brain in self.catalog.unrestrictedSearchResults(portal_type=self.portal_types):
+            reference_number = index.getEntryForObject(brain.getRID())
+            if reference_number:
+                self.reference_numbers[brain.portal_type].add(reference_number)
+
+    def add(self, folder, document_id, portal_type, reference_number=None):
+        self.get_folder_ids(folder).add(document_id)
+        if reference_number:
+            self.get_reference_numbers(portal_type).add(reference_number)
+        self.added.append((folder.getPhysicalPath(), document_id, portal_type, reference_number))
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""Files landing in the root directory, reported once they are complete.
+
+A file is ready to be imported once it, and its metadata file if any, have
+kept the same size and modification time for a while. Metadata files must
+be written before their file, or shortly after it.
+"""
+import logging
+import os
+import time
+
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+
+log = logging.getLogger("collective.dms.batchimport")
+
+
+def get_stat_signature(filepath):
+    """Size and modification time of a file, None if it does not exist anymore."""
+    try:
+        stat = os.stat(filepath)
+    except OSError:
+        return None
+    return (stat.st_size, stat.st_mtime)
+
+
+class Watcher(object):
+    """Yield lists of ready files of the root directory, relative to it.
+
+    Changes are notified by inotify when pyinotify is available, the root
+    directory is scanned every interval seconds otherwise. A file is ready
+    once unchanged for settle seconds; at most max_files files are yielded
+    at once. heartbeat, if any, is called at each turn, e.g. to keep a lock
+    alive while no file lands.
+    """
+
+    def __init__(self, fs_root, settle=2.0, interval=1.0, max_files=100, use_inotify=True, heartbeat=None):
+        self.fs_root = fs_root
+        self.settle = settle
+        self.interval = interval
+        self.max_files = max_files
+        self.use_inotify = use_inotify and pyinotify is not None
+        self.heartbeat = heartbeat
+        # path -> (signature, time since which it has this signature)
+        self.candidates = {}
+        # path -> signature when yielded, not to yield it again while unchanged
+        self.reported = {}
+        self.needs_scan = True
+        self.running = False
+
+    def __iter__(self):
+        notifier = None
+        if self.use_inotify:
+            watch_manager = pyinotify.WatchManager()
+            notifier = pyinotify.Notifier(watch_manager, self.process_event, timeout=int(self.interval * 1000))
+            mask = (
+                pyinotify.IN_CREATE
+                | pyinotify.IN_CLOSE_WRITE
+                | pyinotify.IN_ATTRIB
+                | pyinotify.IN_MOVED_TO
+                | pyinotify.IN_MOVED_FROM
+                | pyinotify.IN_DELETE
+            )
+            watch_manager.add_watch(self.fs_root, mask, rec=True, auto_add=True)
+        log.info("watching %s (%s)" % (self.fs_root, "inotify" if notifier is not None else "polling"))
+        self.running = True
+        try:
+            while self.running:
+                if self.heartbeat is not None:
+                    self.heartbeat()
+                if notifier is None:
+                    self.needs_scan = True
+                elif notifier.check_events():
+                    notifier.read_events()
+                    notifier.process_events()
+                if self.needs_scan:
+                    self.needs_scan = False
+                    self.scan()
+                else:
+                    for path in list(self.candidates):
+                        self.touch(path)
+                ready = self.pop_ready()
+                if ready:
+                    yield ready
+                elif notifier is None:
+                    time.sleep(self.interval)
+        finally:
+            if notifier is not None:
+                notifier.stop()
+
+    def stop(self):
+        self.running = False
+
+    def process_event(self, event):
+        if event.mask & pyinotify.IN_Q_OVERFLOW:
+            log.warning("too many changes in %s, scanning it" % self.fs_root)
+            self.needs_scan = True
+        elif event.dir:
+            # its files may have landed before it is watched
+            if event.mask & (pyinotify.IN_CREATE | pyinotify.IN_MOVED_TO):
+                self.scan(event.pathname)
+        else:
+            self.touch(os.path.relpath(event.pathname, self.fs_root))
+
+    def scan(self, top=None):
+        """Look at all files of a directory, the root directory by default."""
+        seen = set()
+        for basename, dirnames, filenames in os.walk(top or self.fs_root):
+            dirnames[:] = [x for x in dirnames if not x.startswith(".")]
+            for filename in filenames:
+                path = os.path.relpath(os.path.join(basename, filename), self.fs_root)
+                seen.add(path)
+                self.touch(path)
+        if top is None:
+            for path in set(self.reported) - seen:
+                del self.reported[path]
+
+    def touch(self, path):
+        """Take note of the current state of a file."""
+        if any(part.startswith(".") for part in path.split(os.sep)):
+            return
+        signature = get_stat_signature(os.path.join(self.fs_root, path))
+        if signature is None:
+            self.candidates.pop(path, None)
+            self.reported.pop(path, None)
+        elif self.reported.get(path) == signature:
+            return
+        elif path not in self.candidates or self.candidates[path][0] != signature:
+            self.reported.pop(path, None)
+            self.candidates[path] = (signature, time.time())
+
+    def pop_ready(self):
+        """Return the files unchanged for settle seconds, with their metadata files."""
+        now = time.time()
+        ready = []
+        for path in sorted(self.candidates):
+            if len(ready) >= self.max_files:
+                break
+            if path.endswith(".metadata") or now - self.candidates[path][1] < self.settle:
+                continue
+            metadata_path = path + ".metadata"
+            if metadata_path in self.candidates:
+                if now - self.candidates[metadata_path][1] < self.settle:
+                    continue
+                ready.append(metadata_path)
+            ready.append(path)
+        for path in ready:
+            self.reported[path] = self.candidates.pop(path)[0]
+        return ready